@@ -1,14 +1,86 @@
+import io
 import os
-import re
 import shutil
 import glob
 import logging
-from typing import Optional, Union, Dict, Callable, List
+import hashlib
+import threading
+import functools
+import contextlib
+import concurrent.futures
+from typing import (
+    Optional,
+    Union,
+    Dict,
+    Callable,
+    List,
+    Tuple,
+    BinaryIO,
+    Iterable,
+    Sequence,
+)
 
 import numpy as np
 import pandas as pd
 import pyspectra
 
+from bwtek import (
+    DEFAULT_COLUMNS,
+    BWTekFile,
+    parse_bwtek_cached,
+    read_source,
+)
+from cache import DiskLRUCache, cache_key
+from experiments import ExperimentState
+from ratios import RatioTable, ratio_cache
+from utils import MemoryDir
+from peaks import AnalytePeak, Window, analyte_peaks, window_metrics
+from metadata import extract_fields, split_paths
+from reports import (
+    check_spectra_format,
+    write_excel_report,
+    write_spectra_table,
+)
+
+# Raman shift window of the peak used in dielectrophoresis experiments
+DEP_PEAK_WINDOW = Window(1500, 1651)
+# Bump when the computed columns of dep files change, see _dep_state
+DEP_STATE_VERSION = "1"
+# Raman shifts kept by trans and recal
+TRANSFORM_WINDOW = Window(80, 3010)
+# Columns read by trans
+TRANSFORM_COLUMNS = ("Raman Shift", "Dark Subtracted #1")
+
+# Names of files of AgNp synthesis experiments: the spectrum number comes
+# first, the others are missing in some files and taken from the previous
+AGNP_SP_PATTERN = r"^SP_(?P<sp>[0-9]+)[ \.]"
+AGNP_FILENAME_PATTERN = (
+    r"^SP_[0-9]+ (?P<analyte>[a-zA-Z0-9_]+) (?P<concentration>[0-9_]+) "
+    r"AgNP (?P<synthesis>N[1-9]+)\.txt$"
+)
+
+# Peaks of analytes in AgNp synthesis experiments. Windows shared by
+# several analytes are reduced only once, see peaks.compute_metrics
+AGNP_ANALYTES = {
+    "mPBA": AnalytePeak(
+        aliases=("NaAc", "mPBA"),
+        peak=Window(1560, 1590),
+        background=Window(1690, 1710),
+    ),
+    "xanth": AnalytePeak(
+        aliases=("NaAc_x", "xanth"),
+        peak=Window(1690, 1730),
+        background=Window(1990, 2010),
+    ),
+    # Dummy values (peak - itself), for now
+    "amPyr": AnalytePeak(
+        aliases=("NaAc_ap", "amPyr"),
+        peak=Window(1990, 2010),
+        background=Window(1990, 2010),
+        background_metric="max",
+    ),
+}
+
 
 def load_ratio_files(
     ccode: Optional[str] = None,
@@ -19,214 +91,632 @@ def load_ratio_files(
     <DataFrame of the ratio coefficients>.  If `ccode` is provided,
     then only the corresponding DataFrame is returned. I.e. the output is
     equivalent to load_ratio_files()[ccode]
+
+    Files are read through the process-wide `ratios.ratio_cache`, so the
+    returned DataFrames are cheap copies of the cached tables.
     """
+    if ccode is not None:
+        return get_ratio_table(ccode).to_frame()
+
+    return {
+        ccode: get_ratio_table(ccode).to_frame()
+        for ccode in ratio_cache.ccodes(_ratio_files_dir())
+    }
+
+
+def get_ratio_table(ccode: str) -> RatioTable:
+    """Get cached ratio coefficients of `ccode` indexed by pixel"""
+    return ratio_cache.get(_ratio_files_dir(), ccode)
+
+
+def get_ratio_version() -> str:
+    """Fingerprint of the current ratio files"""
+    return ratio_cache.version(_ratio_files_dir())
+
+
+def _ratio_files_dir() -> str:
     from app import app
 
-    RATIO_FILES_DIR = app.config["RATIO_FILES_DIR"]
-    if ccode is not None:
-        ratio_file = os.path.join(RATIO_FILES_DIR, f"{ccode.upper()}.txt")
-        return pd.read_csv(
-            ratio_file, header=None, sep=";", names=["Pixel", "Coeff"]
-        )
+    return app.config["RATIO_FILES_DIR"]
 
-    ratios = {}
-    for ratio_file in glob.glob(
-        os.path.join(RATIO_FILES_DIR, "*.txt"), recursive=False
-    ):
-        ccode = os.path.basename(ratio_file).split(".")[0]
-        df = pd.read_csv(
-            ratio_file, header=None, sep=";", names=["Pixel", "Coeff"]
+
+# Parsed spectra caches by directory, see parse_bwtek
+_spectra_caches = {}  # type: Dict[str, DiskLRUCache]
+# Files parsed in the current shared_parsing block of the thread
+_shared = threading.local()
+
+
+def parse_bwtek(
+    source: Union[str, bytes, BinaryIO],
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+) -> BWTekFile:
+    """Parse a BWTek file through the parsed spectra cache (if enabled)
+
+    Inside a `shared_parsing` block the same content is parsed only once.
+    """
+    parsed = getattr(_shared, "parsed", None)
+    if parsed is None:
+        return parse_bwtek_cached(source, columns, _spectra_cache())
+    raw = read_source(source)
+    key = (hashlib.sha256(raw).digest(), tuple(columns))
+    if key not in parsed:
+        parsed[key] = parse_bwtek_cached(raw, columns, _spectra_cache())
+    return parsed[key]
+
+
+@contextlib.contextmanager
+def shared_parsing():
+    """Keep parsed files in memory until the end of the block
+
+    Several actions run on the same files inside the block parse every
+    file only once. Files are shared within the current thread only, so
+    trans and recal process files serially inside the block.
+    """
+    if getattr(_shared, "parsed", None) is not None:
+        # Nested block, the outer one owns the parsed files
+        yield
+        return
+    _shared.parsed = {}
+    try:
+        yield
+    finally:
+        _shared.parsed = None
+
+
+@contextlib.contextmanager
+def user_experiments(user_id: int):
+    """Keep dep results of files of the user between jobs, see dep"""
+    _shared.user_id = user_id
+    try:
+        yield
+    finally:
+        _shared.user_id = None
+
+
+def _dep_state() -> Optional[ExperimentState]:
+    """State of dep files of the user of the current job, if enabled"""
+    from app import app
+
+    user_id = getattr(_shared, "user_id", None)
+    if user_id is None or not app.config["DEP_INCREMENTAL"]:
+        return None
+    return ExperimentState(
+        os.path.join(app.config["DEP_STATE_DIR"], "%s.pickle" % user_id),
+        cache_key(
+            DEP_STATE_VERSION,
+            get_ratio_version(),
+            *(str(x) for x in DEP_PEAK_WINDOW),
+        ),
+        max_rows=app.config["DEP_STATE_MAX_ROWS"],
+    )
+
+
+def _spectra_cache() -> Optional[DiskLRUCache]:
+    from app import app
+
+    if not app.config["SPECTRA_CACHE_MAX_BYTES"]:
+        return None
+    directory = app.config["SPECTRA_CACHE_DIR"]
+    if directory not in _spectra_caches:
+        _spectra_caches[directory] = DiskLRUCache(
+            directory, app.config["SPECTRA_CACHE_MAX_BYTES"], suffix=".npz"
         )
-        df["Pixel"] = df["Pixel"].astype(np.uint16)
-        ratios[ccode] = df
-    return ratios
+    return _spectra_caches[directory]
+
+
+def spectra_cache_stats() -> Dict[str, int]:
+    """Hits and misses of the parsed spectra caches of the process"""
+    stats = {"hits": 0, "misses": 0}
+    for cache in list(_spectra_caches.values()):
+        for key, value in cache.stats().items():
+            stats[key] += value
+    return stats
 
 
-def read_bwtek_with_ratio_correction(filepath: str) -> pyspectra.Spectra:
+def read_bwtek_with_ratio_correction(
+    filepath: Union[str, BinaryIO]
+) -> pyspectra.Spectra:
     """Read BWTek files with custom ratio files"""
-    # Find a row where the data starts
-    ccode = None
-    with open(filepath, "r") as fp:
-        line = fp.readline()
-        cnt = 0
-        if not line.startswith("File Version;BWSpec"):
-            raise TypeError(
-                "Incorrect BWTek file format. The first row does "
-                "not match 'File Version;BWSpec<...>'"
-            )
+    ccode, wl, spc = apply_ratio_correction(parse_bwtek(filepath))
+    data = pd.DataFrame(
+        {"Raman Shift": wl, "corrected_raw_without_dark": spc}
+    )
+    s = pyspectra.Spectra(
+        spc=data["corrected_raw_without_dark"],
+        wl=data["Raman Shift"],
+        data={"ccode": ccode},
+        keep_indexes=False,
+    )
+    s.reset_index(drop=True, inplace=True)
+    return s
 
-        while line and not line.startswith("Pixel;"):
-            line = fp.readline()
-            if line.startswith("c code;"):
-                ccode = line.split(";")[1].strip()
-            cnt += 1
 
-        # Check that 'c code' and 'Pixel' values were found
-        if ccode is None:
-            raise TypeError(
-                "Incorrect BWTek file format. 'c code' value was not found"
-            )
-        if not line.startswith("Pixel;"):
-            raise TypeError(
-                "Incorrect BWTek file format. Could not to find a "
-                "row starting with 'Pixel;'"
-            )
-        # Get decimal delimiter
-        first_data_line = fp.readline().strip()
-        decimal_del = re.sub("[0-9; -]", "", first_data_line)
-        decimal_del = list(set(list(decimal_del)))
-        if not (len(decimal_del) == 1 and decimal_del[0] in (",", ".")):
-            raise TypeError(
-                "Incorrect BWTek file format. Could not to find the decimal delimiter"
-            )
-        decimal_del = decimal_del[0]
-
-    # CSV read options
-    options = {
-        "skiprows": cnt,
-        "sep": ";",
-        "decimal": decimal_del,
-        "na_values": ("", " ", "  ", "   ", "    "),
-        "usecols": [
-            "Pixel",
-            "Raman Shift",
-            "Dark",
-            "Raw data #1",
-            "Dark Subtracted #1",
-        ],
-        "dtype": np.float64,
-    }
-    data = pd.read_csv(filepath, **options)
-    data["raw_without_dark"] = data["Raw data #1"] - data["Dark"]
+def apply_ratio_correction(
+    parsed: BWTekFile,
+) -> Tuple[str, np.ndarray, np.ndarray]:
+    """Subtract dark and apply ratio coefficients to a parsed BWTek file
+
+    Returns c code, Raman shifts and corrected intensities. Pixels without
+    a Raman shift, a value or a ratio coefficient are dropped.
+    """
+    ccode = parsed.ccode
+    data = parsed.data
+    raw_without_dark = data["Raw data #1"] - data["Dark"]
 
     # Load corresponding ratio coefficients
-    ratio = load_ratio_files(ccode)
+    ratio = get_ratio_table(ccode)
 
-    if data.shape[0] != ratio.shape[0]:
+    if raw_without_dark.shape[0] != ratio.pixels.shape[0]:
         raise TypeError(
             "The spectrum file and the corresponding ratio file have different number of rows"
         )
 
-    # Apply the coefficients. To be sure, join data and ratio coefficients by Pixel value
-    data["Pixel"] = data["Pixel"].astype(ratio["Pixel"].dtype)
-    ratio.set_index("Pixel", inplace=True)
-    data.set_index("Pixel", inplace=True)
-    data = pd.concat([data, ratio], axis=1)
-    data["corrected_raw_without_dark"] = (
-        data["raw_without_dark"] * data["Coeff"]
-    )
+    # Apply the coefficients. To be sure, match data and ratio coefficients
+    # by Pixel value (unknown pixels get NaN and are dropped below)
+    corrected = raw_without_dark * ratio.lookup(data["Pixel"])
 
     # Clear values before writing to the file
-    data = data[["Raman Shift", "corrected_raw_without_dark"]]
-    data.dropna(axis=0, how="any", inplace=True)
+    wl = data["Raman Shift"]
+    keep = ~(np.isnan(wl) | np.isnan(corrected))
+    return ccode, wl[keep], corrected[keep]
 
+
+def read_bwtek(source: Union[str, BinaryIO]) -> pyspectra.Spectra:
+    """Read BWTek file from a path or a binary file-like object
+
+    Paths are read by `pyspectra.read_bwtek` unless the parsed spectra
+    cache or shared parsing is on, file-like objects (and cached files) by
+    the same columns ('Raman Shift' and 'Dark Subtracted #1').
+    """
+    if (
+        isinstance(source, str)
+        and _spectra_cache() is None
+        and getattr(_shared, "parsed", None) is None
+    ):
+        return pyspectra.read_bwtek(source)
+    parsed = parse_bwtek(source, TRANSFORM_COLUMNS)
+    data = pd.DataFrame(parsed.data).dropna(axis=0, how="any")
     s = pyspectra.Spectra(
-        spc=data["corrected_raw_without_dark"],
+        spc=data["Dark Subtracted #1"],
         wl=data["Raman Shift"],
-        data={"ccode": ccode},
         keep_indexes=False,
     )
     s.reset_index(drop=True, inplace=True)
     return s
 
 
+def read_corrected_filelist(
+    files: List[str], tree: Optional[MemoryDir] = None, meta: str = None
+) -> pyspectra.Spectra:
+    """Read BWTek files with ratio correction into a single Spectra object
+
+    This is `pyspectra.read_filelist` with `read_bwtek_with_ratio_correction`
+    reader, but the correction is applied to the whole batch at once: files
+    are stacked into a float32 matrix per c code and dark subtraction and
+    ratio coefficients are applied as single broadcast operations. Files
+    are read from `tree` if given. `meta` is a header value to add to the
+    data of every spectrum.
+    """
+    if not files:
+        raise ValueError("No files to read")
+    parsed = [
+        parse_bwtek(filename if tree is None else tree[filename])
+        for filename in files
+    ]
+    data = pd.DataFrame(
+        {
+            "filename": list(files),
+            "ccode": [p.ccode for p in parsed],
+        }
+    )
+    if meta is not None:
+        data[meta] = [p.metadata.get(meta) for p in parsed]
+
+    # Blocks of rows sharing the same Raman shift axis
+    blocks = []
+    for ccode, rows in data.groupby("ccode", sort=False).indices.items():
+        blocks.extend(_correct_group(ccode, [parsed[i] for i in rows], rows))
+    del parsed
+
+    spc = _assemble_blocks(blocks, data.shape[0])
+    return pyspectra.Spectra(
+        spc=spc, wl=spc.columns.values, data=data, keep_indexes=False
+    )
+
+
+def _assemble_blocks(
+    blocks: List[Tuple[np.ndarray, np.ndarray, np.ndarray]], n_rows: int
+) -> pd.DataFrame:
+    """Put (rows, Raman shifts, values) blocks into a single matrix
+
+    Rows of blocks with different Raman shift axes are aligned by Raman
+    shift, missing values are NaN.
+    """
+    if all(np.array_equal(wl, blocks[0][1]) for _, wl, _ in blocks):
+        # Common case: a single shared axis, just put the rows in place
+        wl = blocks[0][1]
+        spc = np.empty((n_rows, wl.shape[0]), dtype=np.float32)
+        for rows, _, values in blocks:
+            spc[rows] = values
+        return pd.DataFrame(spc, columns=wl)
+    return (
+        pd.concat(
+            [
+                pd.DataFrame(values, index=rows, columns=wl)
+                for rows, wl, values in blocks
+            ],
+            sort=False,
+        )
+        .sort_index(axis=0)
+        .sort_index(axis=1)
+    )
+
+
+def _correct_group(
+    ccode: str, parsed: List[BWTekFile], rows: np.ndarray
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Apply ratio correction to files of the same c code
+
+    Returns a list of (rows, Raman shifts, corrected values) blocks.
+    """
+    ratio = get_ratio_table(ccode)
+    pixels = parsed[0].data["Pixel"]
+    if any(not np.array_equal(p.data["Pixel"], pixels) for p in parsed):
+        # Files of different layouts, correct them one by one
+        blocks = []
+        for row, p in zip(rows, parsed):
+            _, wl, spc = apply_ratio_correction(p)
+            blocks.append((np.array([row]), wl, spc[np.newaxis, :]))
+        return blocks
+
+    if pixels.shape[0] != ratio.pixels.shape[0]:
+        raise TypeError(
+            "The spectrum file and the corresponding ratio file have different number of rows"
+        )
+    coeffs = ratio.lookup(pixels).astype(np.float32)
+    raw = np.vstack([p.data["Raw data #1"] for p in parsed]).astype(np.float32)
+    raw -= np.vstack([p.data["Dark"] for p in parsed]).astype(np.float32)
+    raw *= coeffs
+
+    wl = np.vstack([p.data["Raman Shift"] for p in parsed])
+    if ((wl == wl[0]) | (np.isnan(wl) & np.isnan(wl[0]))).all():
+        keep = ~(np.isnan(wl[0]) | np.isnan(coeffs))
+        return [(rows, wl[0][keep], raw[:, keep])]
+    blocks = []
+    for i, row in enumerate(rows):
+        keep = ~(np.isnan(wl[i]) | np.isnan(coeffs))
+        blocks.append((np.array([row]), wl[i][keep], raw[i : i + 1, keep]))
+    return blocks
+
+
 def transform_bwtek_single_file(
-    filepath: str, recalibrate: bool = False
+    filepath: str, recalibrate: bool = False, tree: Optional[MemoryDir] = None
 ) -> None:
-    """Transform a single BWTek-file (with replacement) to a two-columns *.txt file"""
+    """Transform a single BWTek-file (with replacement) to a two-columns *.txt file
+
+    If `tree` is given, the file is read from and written to the MemoryDir.
+    """
+    source = filepath if tree is None else tree.open(filepath)
     if recalibrate:
-        spc = read_bwtek_with_ratio_correction(filepath)
+        spc = read_bwtek_with_ratio_correction(source)
     else:
-        spc = pyspectra.read_bwtek(filepath)
-    spc = spc[:, :, 80:3010]
+        spc = read_bwtek(source)
+    spc = spc[:, :, TRANSFORM_WINDOW.lo : TRANSFORM_WINDOW.hi]
     df = pd.DataFrame({"wl": spc.wl, "spc": spc.spc.iloc[0, :].values})
-    df.to_csv(filepath, header=False, index=False)
+    if tree is None:
+        df.to_csv(filepath, header=False, index=False)
+    else:
+        tree[filepath] = df.to_csv(header=False, index=False).encode("utf-8")
+
+
+def read_transformed_filelist(
+    files: Iterable[str],
+    recalibrate: bool = False,
+    tree: Optional[MemoryDir] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, bool]]:
+    """Read spectra of files as trans/recal write them into one matrix
+
+    Returns spectra (a row per file, Raman shifts as columns), their data
+    (filename and c code) and the status of every file. Files that cannot
+    be read are logged and skipped.
+    """
+    blocks = []
+    rows = []
+    files_status = {}
+    for filename in files:
+        source = filename if tree is None else tree[filename]
+        try:
+            if recalibrate:
+                ccode, wl, values = apply_ratio_correction(parse_bwtek(source))
+            else:
+                parsed = parse_bwtek(source, TRANSFORM_COLUMNS)
+                ccode = parsed.ccode
+                wl = parsed.data["Raman Shift"]
+                values = parsed.data["Dark Subtracted #1"]
+        except Exception as e:
+            logging.error(e)
+            files_status[filename] = False
+            continue
+        keep = (
+            (wl >= TRANSFORM_WINDOW.lo)
+            & (wl <= TRANSFORM_WINDOW.hi)
+            & ~np.isnan(values)
+        )
+        blocks.append(
+            (
+                np.array([len(rows)]),
+                wl[keep],
+                values[keep][np.newaxis, :].astype(np.float32),
+            )
+        )
+        rows.append((filename, ccode))
+        files_status[filename] = True
+
+    data = pd.DataFrame(rows, columns=["filename", "ccode"])
+    spc = _assemble_blocks(blocks, len(rows)) if rows else pd.DataFrame()
+    return spc, data, files_status
+
+
+EXECUTORS = ("serial", "thread", "process")
 
 
 def transform_files(
-    files: List[str], callback: Callable, **kwargs
+    files: Iterable[str],
+    callback: Callable,
+    executor: str = "serial",
+    workers: Optional[int] = None,
+    chunksize: int = 1,
+    **kwargs,
 ) -> Dict[str, bool]:
-    """ Call a callback function for each file in a file list"""
+    """ Call a callback function for each file in a file list
+
+    Files are processed one by one (`executor="serial"`) or in a thread
+    or process pool of `workers` size. For the process pool the callback
+    must be picklable (i.e. a module-level function) and files are sent to
+    workers in chunks of `chunksize`. In all cases the output keeps the
+    order of `files`.
+
+    If the callback gets a MemoryDir (`tree` keyword argument), files are
+    looked up in it and the process pool is replaced by the thread one:
+    changes made in other processes would be lost.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(
+            "Unknown executor: %s. Expected one of: %s"
+            % (executor, ", ".join(EXECUTORS))
+        )
+    tree = kwargs.get("tree")
+    if tree is None:
+        files = (filename for filename in files if os.path.isfile(filename))
+    else:
+        files = (filename for filename in files if filename in tree)
+        if executor == "process":
+            executor = "thread"
+    call = functools.partial(_call_callback, callback=callback, kwargs=kwargs)
+
+    if executor == "serial":
+        results = map(call, files)  # type: Iterable[Tuple[str, bool, str]]
+    else:
+        pool_class = (
+            concurrent.futures.ThreadPoolExecutor
+            if executor == "thread"
+            else concurrent.futures.ProcessPoolExecutor
+        )
+        with pool_class(max_workers=workers) as pool:
+            results = list(pool.map(call, files, chunksize=chunksize))
+
     files_status = {}
-    for filename in files:
-        if os.path.isfile(filename):
-            try:
-                callback(filename, **kwargs)
-                files_status[filename] = True
-            except Exception as e:
-                files_status[filename] = False
-                logging.error(e)
+    for filename, status, error in results:
+        files_status[filename] = status
+        if not status:
+            logging.error(error)
     return files_status
 
 
-def transform_bwtek(target_dir: str) -> Dict[str, bool]:
-    files = glob.iglob(os.path.join(target_dir, "**/*.txt"), recursive=True)
-    return transform_files(files, transform_bwtek_single_file)
+def _call_callback(
+    filename: str, callback: Callable, kwargs: Dict
+) -> Tuple[str, bool, str]:
+    # Exceptions are returned as strings: they are not always picklable
+    try:
+        callback(filename, **kwargs)
+        return filename, True, ""
+    except Exception as e:
+        return filename, False, str(e)
 
 
-def recalibrate_bwtek(target_dir: str) -> Dict[str, bool]:
-    files = glob.iglob(os.path.join(target_dir, "**/*.txt"), recursive=True)
-    return transform_files(
-        files, transform_bwtek_single_file, recalibrate=True
-    )
+def _executor_options() -> Dict:
+    from app import app
 
+    if getattr(_shared, "parsed", None) is not None:
+        # Parsed files are shared within the thread, see shared_parsing
+        return {"executor": "serial"}
+    return {
+        "executor": app.config["TRANSFORM_EXECUTOR"],
+        "workers": app.config["TRANSFORM_WORKERS"],
+        "chunksize": app.config["TRANSFORM_CHUNKSIZE"],
+    }
 
-def dep(target_dir: str) -> Dict[str, bool]:
-    """Build summary of a dielectrophoresis experiment"""
 
-    # If all in one root dir switch to it
-    content = os.listdir(target_dir)
-    if (len(content) == 1) and (
-        os.path.isdir(os.path.join(target_dir, content[0]))
-    ):
-        target_dir = os.path.join(target_dir, content[0])
+def is_spectrum_file(relpath: str) -> bool:
+    """Whether actions read the file, i.e. it matches `**/*.txt` glob"""
+    parts = relpath.replace(os.path.sep, "/").split("/")
+    return parts[-1].endswith(".txt") and not any(
+        part.startswith(".") for part in parts
+    )
 
-    # Read all files
-    files = glob.glob(os.path.join(target_dir, "**/*.txt"), recursive=True)
-    s = pyspectra.read_filelist(
-        files, read_bwtek_with_ratio_correction, meta="Date"
+
+def list_spectrum_files(target_dir: Union[str, MemoryDir]) -> List[str]:
+    if isinstance(target_dir, MemoryDir):
+        return sorted(
+            filepath
+            for filepath in target_dir
+            if is_spectrum_file(os.path.relpath(filepath, target_dir.path))
+        )
+    return sorted(
+        glob.iglob(os.path.join(target_dir, "**/*.txt"), recursive=True)
     )
-    s.reset_index(drop=True, inplace=True)
-    df = s.data
-    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d %H:%M:%S")
 
-    # Folder of the file
-    df["folder"] = (
-        df["filename"]
-        .apply(os.path.dirname)
-        .str.slice(start=len(target_dir))
-        .str.lstrip(os.path.sep)
-        .astype("category")
+
+def _tree_options(target_dir: Union[str, MemoryDir]) -> Dict:
+    return {"tree": target_dir} if isinstance(target_dir, MemoryDir) else {}
+
+
+# All actions accept an optional iterable of files to process instead of
+# the whole `target_dir` content. The iterable may be lazy (e.g. files that
+# are still being extracted), trans and recal start processing right away.
+# `target_dir` is either a directory or a MemoryDir (in-memory processing).
+def transform_bwtek(
+    target_dir: Union[str, MemoryDir],
+    files: Optional[Iterable[str]] = None,
+    output_format: Optional[str] = None,
+) -> Dict[str, bool]:
+    return _transform(target_dir, files, False, output_format)
+
+
+def recalibrate_bwtek(
+    target_dir: Union[str, MemoryDir],
+    files: Optional[Iterable[str]] = None,
+    output_format: Optional[str] = None,
+) -> Dict[str, bool]:
+    return _transform(target_dir, files, True, output_format)
+
+
+def _transform(
+    target_dir: Union[str, MemoryDir],
+    files: Optional[Iterable[str]],
+    recalibrate: bool,
+    output_format: Optional[str] = None,
+) -> Dict[str, bool]:
+    """Rewrite files to two-column *.txt files and/or a columnar file
+
+    With an output format (see `_output_options`) all spectra are also
+    written to a single `spectra.<format>` file in `target_dir`, next to
+    or instead of the rewritten files.
+    """
+    if files is None:
+        files = list_spectrum_files(target_dir)
+    output_format, keep_txt = _output_options(output_format)
+    if output_format is None:
+        return transform_files(
+            files,
+            transform_bwtek_single_file,
+            recalibrate=recalibrate,
+            **_tree_options(target_dir),
+            **_executor_options(),
+        )
+
+    # The batch file is read from the original files, before they are
+    # rewritten
+    files = list(files)
+    tree = target_dir if isinstance(target_dir, MemoryDir) else None
+    spc, data, files_status = read_transformed_filelist(
+        files, recalibrate, tree
     )
+    if data.shape[0]:
+        root = target_dir if tree is None else tree.path
+        data["filename"] = [
+            os.path.relpath(filename, root) for filename in data["filename"]
+        ]
+        write_spectra_file(root, spc, data, output_format, tree)
+
+    if not keep_txt:
+        # Only the batch file is left instead of the read files
+        for filename, status in files_status.items():
+            if status and tree is None:
+                os.remove(filename)
+            elif status:
+                del tree[filename]
+        return files_status
+
+    for filename, status in transform_files(
+        files,
+        transform_bwtek_single_file,
+        recalibrate=recalibrate,
+        **_tree_options(target_dir),
+        **_executor_options(),
+    ).items():
+        files_status[filename] = files_status.get(filename, True) and status
+    return files_status
+
+
+def write_spectra_file(
+    target_dir: str,
+    spc: pd.DataFrame,
+    data: pd.DataFrame,
+    output_format: str,
+    tree: Optional[MemoryDir] = None,
+) -> str:
+    """Write spectra to `spectra.<output_format>` in `target_dir`"""
+    filepath = os.path.join(target_dir, "spectra.%s" % output_format)
+    output = filepath if tree is None else io.BytesIO()
+    write_spectra_table(output, spc, data, output_format)
+    if tree is not None:
+        tree[filepath] = output.getvalue()
+    return filepath
+
+
+def _output_options(output_format: Optional[str] = None) -> Tuple:
+    """Columnar output format (None if off) and whether to keep *.txt"""
+    from app import app
+
+    output_format = output_format or app.config["BATCH_OUTPUT_FORMAT"]
+    if not output_format:
+        return None, True
+    check_spectra_format(output_format)
+    return output_format, app.config["BATCH_OUTPUT_KEEP_TXT"]
+
+
+def dep(
+    target_dir: Union[str, MemoryDir],
+    files: Optional[Iterable[str]] = None,
+    output_format: Optional[str] = None,
+) -> Dict[str, bool]:
+    """Build summary of a dielectrophoresis experiment"""
+    output_format, _ = _output_options(output_format)
+    # Wait for all files to be ready
+    if files is None:
+        files = list_spectrum_files(target_dir)
+    files = list(files)
+    tree = target_dir if isinstance(target_dir, MemoryDir) else None
+    if tree is not None:
+        target_dir = tree.path
 
-    # Experiment is the first folder of the file
-    df["experiment"] = (
-        df["folder"]
-        .astype("str")
-        .apply(lambda x: x.split(os.path.sep)[0])
-        .astype("category")
+    # If all in one root dir switch to it
+    listdir, isdir = (
+        (os.listdir, os.path.isdir)
+        if tree is None
+        else (tree.listdir, tree.isdir)
     )
+    content = listdir(target_dir)
+    if (len(content) == 1) and (isdir(os.path.join(target_dir, content[0]))):
+        target_dir = os.path.join(target_dir, content[0])
+
+    # Spectra of all files are needed for the columnar output
+    state = _dep_state() if output_format is None else None
+    if state is None:
+        spc, df = _dep_metrics(files, tree)
+    else:
+        df = _dep_metrics_incremental(files, tree, target_dir, state)
 
+    # Folder of the file, experiment is the first folder of the file
+    paths = split_paths(df["filename"], target_dir)
+    df["folder"] = paths["folder"].values
+    df["experiment"] = paths["experiment"].values
     # Remove folder from filename (this also uses less memory)
-    df["filename"] = df["filename"].apply(os.path.basename)
+    df["filename"] = paths["filename"].values
 
     # Calculate relative time
-    start_time = df.groupby("experiment")["Date"].min()
-    df["start_time"] = start_time[df.experiment.values].values
+    df["start_time"] = df.groupby("experiment", observed=True)[
+        "Date"
+    ].transform("min")
     df["relative_time, sec"] = (
         (df["Date"] - df["start_time"]).dt.total_seconds().astype(np.uint16)
     )
 
-    # Calculate relative peak intensity
-    spc = s[:, :, 1500:1651]
-    bl = spc.copy()
-    bl.spc.iloc[:, 1:-1] = np.nan
-    bl.approx_na(inplace=True, method="linear")
-    df["relative_peak"] = (spc - bl).spc.max(axis=1).values.round(1)
-
     # Clear target dir to keep only reports
-    shutil.rmtree(target_dir, ignore_errors=True)
-    os.mkdir(target_dir)
+    _clear_dir(target_dir, tree)
+    if output_format is not None:
+        write_spectra_file(target_dir, spc, df, output_format, tree)
 
     # Write to excel
     df.sort_values(by=["experiment", "Date"], inplace=True)
@@ -238,107 +728,261 @@ def dep(target_dir: str) -> Dict[str, bool]:
         "relative_time, sec",
         "relative_peak",
     ]
-    with pd.ExcelWriter(
-        os.path.join(target_dir, "report.xlsx"), engine="openpyxl"
-    ) as writer:
-        for experiment in df["experiment"].cat.categories:
-            df.loc[df["experiment"] == experiment, columns].to_excel(
-                writer, sheet_name=experiment, header=True, index=False
-            )
-            writer.sheets[experiment].column_dimensions["A"].width = (
-                df.loc[df["experiment"] == experiment, "folder"]
-                .str.len()
-                .max()
-                + 2
-            )
-            writer.sheets[experiment].column_dimensions["B"].width = 20
-            writer.sheets[experiment].column_dimensions["C"].width = 20
-            writer.sheets[experiment].column_dimensions["D"].width = 20
-            writer.sheets[experiment].column_dimensions["E"].width = 15
+    report = os.path.join(target_dir, "report.xlsx")
+    output = report if tree is None else io.BytesIO()
+    write_excel_report(
+        output,
+        df,
+        "experiment",
+        columns,
+        widths={
+            "folder": "auto",
+            "filename": 20,
+            "datetime": 20,
+            "relative_time, sec": 20,
+            "relative_peak": 15,
+        },
+    )
+    if tree is not None:
+        tree[report] = output.getvalue()
     return {"report.xlsx": True}
 
 
-def process_agnp_synthesis_experiments(target_dir: str) -> Dict[str, bool]:
+def _dep_metrics(
+    files: List[str], tree: Optional[MemoryDir] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Spectra of dep files and their filename, Date and relative_peak"""
+    s = read_corrected_filelist(files, tree, meta="Date")
+    s.reset_index(drop=True, inplace=True)
+    df = s.data
+    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d %H:%M:%S")
+    # Calculate relative peak intensity: the peak height above a two-point
+    # linear baseline of the window
+    df["relative_peak"] = window_metrics(
+        s.spc.values, s.wl, DEP_PEAK_WINDOW, metrics=("baseline_max",)
+    )["baseline_max"].round(1)
+    return s.spc, df
+
+
+def _dep_metrics_incremental(
+    files: List[str],
+    tree: Optional[MemoryDir],
+    target_dir: str,
+    state: ExperimentState,
+) -> pd.DataFrame:
+    """`_dep_metrics` data computed only for files missing in the state
+
+    Files are matched by the path relative to `target_dir` and content,
+    then the rows of all files are updated in the state, so that the
+    files of recent uploads are the last to be dropped from it.
+    """
+    if not files:
+        raise ValueError("No files to read")
+    keys = [os.path.relpath(filename, target_dir) for filename in files]
+    hashes = [
+        hashlib.sha256(
+            read_source(filename if tree is None else tree[filename])
+        ).hexdigest()
+        for filename in files
+    ]
+    known = state.load()
+    if known.empty:
+        seen = np.zeros(len(files), dtype=bool)
+    else:
+        seen = known["hash"].reindex(keys).values == np.array(hashes)
+    logging.debug(
+        "dep: %s of %s files are known from previous jobs"
+        % (seen.sum(), len(files))
+    )
+
+    parts = []
+    if seen.any():
+        rows = known.loc[[k for k, ok in zip(keys, seen) if ok]]
+        parts.append(
+            pd.DataFrame(
+                {
+                    "filename": [f for f, ok in zip(files, seen) if ok],
+                    "Date": rows["Date"].values,
+                    "relative_peak": rows["relative_peak"].values,
+                },
+                index=np.flatnonzero(seen),
+            )
+        )
+    if not seen.all():
+        new = np.flatnonzero(~seen)
+        _, df = _dep_metrics([files[i] for i in new], tree)
+        df = df[["filename", "Date", "relative_peak"]].set_index(new)
+        parts.append(df)
+    # Same row order as without the state
+    df = pd.concat(parts, sort=False).sort_index()
+    state.update(
+        pd.DataFrame(
+            {
+                "hash": hashes,
+                "Date": df["Date"].values,
+                "relative_peak": df["relative_peak"].values,
+            },
+            index=keys,
+        )
+    )
+    return df
+
+
+def process_agnp_synthesis_experiments(
+    target_dir: Union[str, MemoryDir],
+    files: Optional[Iterable[str]] = None,
+    output_format: Optional[str] = None,
+) -> Dict[str, bool]:
     """Build summary of an AgNp synthesis experiment"""
+    output_format, _ = _output_options(output_format)
     # Read all files
-    files = glob.glob(os.path.join(target_dir, "**/*.txt"), recursive=True)
-    s = pyspectra.read_filelist(files, read_bwtek_with_ratio_correction)
+    if files is None:
+        files = list_spectrum_files(target_dir)
+    files = list(files)
+    tree = target_dir if isinstance(target_dir, MemoryDir) else None
+    if tree is not None:
+        target_dir = tree.path
+    s = read_corrected_filelist(files, tree)
     s.reset_index(drop=True, inplace=True)
     df = s.data
 
-    # Keep only used region to use less memory
-    df["peak_mPBA"] = (
-        # Peak - background
-        s[:, :, 1560:1590].spc.max(axis=1)
-        - s[:, :, 1690:1710].spc.median(axis=1)
-    )
-    df["peak_xanth"] = (
-        # Peak - background
-        s[:, :, 1690:1730].spc.max(axis=1)
-        - s[:, :, 1990:2010].spc.median(axis=1)
-    )
-    df["peak_amPyr"] = (
-        # Peak - background. Dummy values, for now
-        s[:, :, 1990:2010].spc.max(axis=1)
-        - s[:, :, 1990:2010].spc.max(axis=1)
-    )
+    # Peak - background of every analyte
+    for analyte, values in analyte_peaks(
+        s.spc.values, s.wl, AGNP_ANALYTES
+    ).items():
+        df["peak_" + analyte] = values
+    spc = s.spc if output_format is not None else None
     del s
 
     # Folder of the file
-    df["folder"] = (
-        df["filename"]
-        .apply(lambda x: x.split(os.path.sep)[-2])
-        .astype("category")
-    )
-    df["filename"] = df["filename"].apply(os.path.basename)
+    paths = split_paths(df["filename"], target_dir)
+    df["folder"] = paths["parent"].values
+    df["filename"] = paths["filename"].values
 
     # Sort and fill missing values
     df["sp"] = (
-        df["filename"].str.extract(r"^SP_([0-9]+)[ \.]").astype(np.uint16)
+        extract_fields(df["filename"], AGNP_SP_PATTERN, {"sp": int})["sp"]
+        .astype(np.uint16)
+        .values
     )
     df.sort_values(["folder", "sp"], inplace=True)
-    df[["analyte", "concentration", "synthesis"]] = df["filename"].str.extract(
-        r"^SP_[0-9]+ ([a-zA-Z0-9_]+) ([0-9_]+) AgNP (N[1-9]+)\.txt$"
+    fields = extract_fields(
+        df["filename"],
+        AGNP_FILENAME_PATTERN,
+        {"concentration": lambda c: float(c.replace("_", "."))},
     )
+    for column in fields:
+        df[column] = fields[column].values
     df.fillna(method="ffill", inplace=True)
 
     # Format fields
-    df["concentration"] = (
-        df["concentration"]
-        .str.replace("_", ".", regex=False)
-        .astype(np.float32)
-    )
-    df["synthesis"] = df["synthesis"].astype("category")
-    df["peak"] = (
-        df["peak_mPBA"] * df["analyte"].isin(["NaAc", "mPBA"]).astype(np.uint8)
-        + df["peak_xanth"]
-        * df["analyte"].isin(["NaAc_x", "xanth"]).astype(np.uint8)
-        + df["peak_amPyr"]
-        * df["analyte"].isin(["NaAc_ap", "amPyr"]).astype(np.uint8)
+    df["concentration"] = df["concentration"].astype(np.float32)
+    df["peak"] = sum(
+        df["peak_" + analyte]
+        * df["analyte"].isin(peak.aliases).astype(np.uint8)
+        for analyte, peak in AGNP_ANALYTES.items()
     )
 
     # Build the pivot
     df["repetition"] = (
-        df.groupby(["folder", "synthesis", "concentration"])["sp"]
+        df.groupby(["folder", "synthesis", "concentration"], observed=True)[
+            "sp"
+        ]
         .rank(method="first", ascending=True)
         .astype(np.uint8)
     )
-    df["sr"] = df["synthesis"].astype(str) + "_" + df["repetition"].astype(str)
     res = df.pivot_table(
-        values="peak", index=["folder", "concentration"], columns=["sr"]
-    ).reset_index()
+        values="peak",
+        index=["folder", "concentration"],
+        columns=["synthesis", "repetition"],
+    )
+    # Columns are named by synthesis and repetition, e.g. N1_2
+    res.columns = ["%s_%s" % column for column in res.columns]
+    res = res[sorted(res.columns)].reset_index()
     res["avg"] = res.iloc[:, 2:].mean(axis=1)
 
     # Clear target dir to keep only reports
-    shutil.rmtree(target_dir, ignore_errors=True)
-    os.mkdir(target_dir)
+    _clear_dir(target_dir, tree)
+    if output_format is not None:
+        # Rows of df have been sorted, restore the order of spectra
+        write_spectra_file(
+            target_dir, spc, df.sort_index(), output_format, tree
+        )
 
     # Write to Excel file
-    with pd.ExcelWriter(
-        os.path.join(target_dir, "peak_values.xlsx"), engine="openpyxl"
-    ) as writer:
-        for folder in df["folder"].cat.categories:
-            res.loc[df["folder"] == folder, res.columns != "folder"].to_excel(
-                writer, sheet_name=folder, header=True, index=False
-            )
+    report = os.path.join(target_dir, "peak_values.xlsx")
+    output = report if tree is None else io.BytesIO()
+    write_excel_report(
+        output,
+        res,
+        "folder",
+        [column for column in res.columns if column != "folder"],
+        sheets=df["folder"].cat.categories,
+    )
+    if tree is not None:
+        tree[report] = output.getvalue()
     return {"peak_values.xlsx": True}
+
+
+def run_pipeline(
+    target_dir: Union[str, MemoryDir],
+    actions: Dict[str, Callable],
+    files: Optional[Iterable[str]] = None,
+) -> Dict[str, bool]:
+    """Run several actions on the same files parsing every file once
+
+    Every action gets its own copy of the spectrum files in the
+    `<target_dir>/<action name>` folder (the originals are removed), so
+    the results of all actions end up in one directory. Returns statuses
+    of the files of all actions by the paths of their copies; all files
+    of an action that raised an error are failed and its folder is
+    removed, so the raw copies are not sent as its results.
+    """
+    tree = target_dir if isinstance(target_dir, MemoryDir) else None
+    root = target_dir if tree is None else tree.path
+    # Wait for all files: the copies are made from the complete set
+    sources = list_spectrum_files(target_dir) if files is None else list(files)
+
+    targets = {}  # type: Dict[str, Union[str, MemoryDir]]
+    copies = {}  # type: Dict[str, List[str]]
+    for name in actions:
+        action_dir = os.path.join(root, name)
+        targets[name] = action_dir if tree is None else MemoryDir(action_dir)
+        copies[name] = []
+        for filepath in sources:
+            copy = os.path.join(action_dir, os.path.relpath(filepath, root))
+            if tree is None:
+                os.makedirs(os.path.dirname(copy), exist_ok=True)
+                shutil.copyfile(filepath, copy)
+            else:
+                targets[name][copy] = tree[filepath]
+            copies[name].append(copy)
+    for filepath in sources:
+        if tree is None:
+            os.remove(filepath)
+        else:
+            del tree[filepath]
+
+    files_status = {}
+    with shared_parsing():
+        for name, action in actions.items():
+            try:
+                files_status.update(action(targets[name]))
+            except Exception as e:
+                # Other actions still give their results
+                logging.error("Action %s failed: %s" % (name, e))
+                files_status.update({copy: False for copy in copies[name]})
+                if tree is None:
+                    shutil.rmtree(targets[name], ignore_errors=True)
+                continue
+            if tree is not None:
+                tree.update(targets[name])
+    return files_status
+
+
+def _clear_dir(target_dir: str, tree: Optional[MemoryDir] = None) -> None:
+    if tree is None:
+        shutil.rmtree(target_dir, ignore_errors=True)
+        os.mkdir(target_dir)
+    else:
+        tree.rmtree(target_dir)
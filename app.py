@@ -1,10 +1,11 @@
 # BUILD-IN
 import os
+import sys
 import logging
 
 # THIRD PARTIES
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, Response, request
 import telegram
 
 # OWN
@@ -15,11 +16,70 @@ BASEDIR = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(BASEDIR, ".env"))
 HOST = os.environ["HOST"]
 
+# Handlers import this module as `app`, also when it is run as a script
+sys.modules.setdefault("app", sys.modules[__name__])
+
 # Create an app
 app = Flask(__name__)
 app.config.from_object(os.environ["FLASK_APP_SETTINGS"])
 db.init_app(app)
-from bot import bot, updater, dispatcher  # noqa: E402
+from bot import (  # noqa: E402
+    bot,
+    updater,
+    dispatcher,
+    process_job,
+    notify_job_failure,
+)
+from jobs import JobQueue  # noqa: E402
+from cache import DiskLRUCache  # noqa: E402
+from repository import UserFileRepository  # noqa: E402
+from downloads import TelegramFileCache  # noqa: E402
+from metrics import job_metrics  # noqa: E402
+from ratios import ratio_cache  # noqa: E402
+from actions import spectra_cache_stats  # noqa: E402
+
+# Actions are run in background by the job queue workers
+job_queue = JobQueue.from_config(
+    app, process_job, on_failure=notify_job_failure
+)
+result_cache = DiskLRUCache(
+    app.config["RESULT_CACHE_DIR"],
+    app.config["RESULT_CACHE_MAX_BYTES"],
+    suffix=".zip",
+)
+userfiles = UserFileRepository(app, app.config["USERFILE_CACHE_SIZE"])
+# Uploads of a Telegram file reuse its getFile result and its content
+telegram_files = TelegramFileCache(app.config["TELEGRAM_FILE_TTL"])
+download_cache = DiskLRUCache(
+    app.config["DOWNLOAD_CACHE_DIR"], app.config["DOWNLOAD_CACHE_MAX_BYTES"]
+)
+
+job_metrics.register(
+    "ibcp_jobs_in_state",
+    "gauge",
+    "Jobs in the queue by state",
+    lambda: [
+        ({"state": state}, count)
+        for state, count in job_queue.state_counts(max_age=5).items()
+    ],
+)
+job_metrics.register(
+    "ibcp_cache_requests_total",
+    "counter",
+    "Cache lookups by cache and result",
+    lambda: [
+        ({"cache": name, "result": result}, stats[result])
+        for name, stats in (
+            ("result", result_cache.stats()),
+            ("ratio", ratio_cache.stats()),
+            ("spectra", spectra_cache_stats()),
+            ("userfile", userfiles.stats()),
+            ("telegram_file", telegram_files.stats()),
+            ("download", download_cache.stats()),
+        )
+        for result in ("hits", "misses")
+    ],
+)
 
 
 @app.route("/")
@@ -27,6 +87,11 @@ def hello_world():
     return "Hello Flask!"
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(job_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/webhook/" + app.config["BOT_TOKEN"], methods=["POST"])
 def webhook():
     # Retrieve the message in JSON and then transform it to Telegram object
@@ -49,6 +114,12 @@ def set_webhook():
         raise Exception("Webhook setup failed")
 
 
+# Job workers run from startup, so jobs left by a previous process are
+# picked up without waiting for a new one (manage.py turns this off)
+if app.config["JOB_QUEUE_AUTOSTART"]:
+    job_queue.start()
+
+
 if __name__ == "__main__":
     if app.config["DEBUG"]:
         logging.basicConfig(
@@ -0,0 +1,297 @@
+"""Benchmarks of the hot paths of the bot on synthetic BWTek data
+
+Usage: python benchmarks/run.py [--sizes 10,100,500] [--repeat 3]
+                                [--only dep,agnp] [--executor process]
+                                [--dot-decimals] [--spectra-cache]
+                                [--output result.json]
+                                [--compare previous.json]
+
+No Telegram or network access is needed: the bot is configured with dummy
+settings and only the functions behind the actions are called. Results are
+written as JSON (to benchmarks/results/<UTC time>.json by default), so runs
+can be compared with `--compare`.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import subprocess
+from typing import Callable, Dict, List, Optional
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from synthetic import (  # noqa: E402
+    make_agnp_layout,
+    make_archive,
+    make_dep_layout,
+    ratio_pixels,
+)
+
+BENCHMARKS = (
+    "read_bwtek_with_ratio_correction",
+    "transform_bwtek",
+    "recalibrate_bwtek",
+    "dep",
+    "process_agnp_synthesis_experiments",
+    "zipdir",
+    "extract_file",
+)
+
+
+def configure(
+    workdir: str, executor: str = "serial", spectra_cache: bool = False
+) -> None:
+    """Dummy settings, so that the bot modules can be imported offline"""
+    defaults = {
+        "HOST": "localhost",
+        "SECRET_KEY": "benchmark",
+        "TELEGRAM_BOT_TOKEN": "123456:benchmark",
+        "DATABASE_URL": "sqlite://",
+        "FLASK_APP_SETTINGS": "config.Config",
+        # Actions are run in process, not by the job workers
+        "JOB_QUEUE_AUTOSTART": "0",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    # The bot writes its log to the working directory
+    os.chdir(workdir)
+
+    from app import app
+
+    app.config["TRANSFORM_EXECUTOR"] = executor
+    app.config["BATCH_OUTPUT_FORMAT"] = ""
+    app.config["SPECTRA_CACHE_DIR"] = os.path.join(workdir, "spectra cache")
+    app.config["SPECTRA_CACHE_MAX_BYTES"] = 1024**3 if spectra_cache else 0
+
+
+def timeit(
+    run: Callable, setup: Optional[Callable] = None, repeat: int = 3
+) -> List[float]:
+    """Wall time of `repeat` calls of `run`, `setup` is not timed"""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def fresh_copy(src: str, dst: str) -> Callable:
+    """Setup which restores `dst` from `src` (actions change their input)"""
+
+    def setup():
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst)
+        return (dst,)
+
+    return setup
+
+
+def make_data(workdir: str, n_files: int, comma: bool) -> Dict[str, str]:
+    """Generate dep and agnp layouts of `n_files` and an upload archive"""
+    from app import app
+
+    ccode = "NLU"
+    n_pixels = ratio_pixels(app.config["RATIO_FILES_DIR"], ccode)
+    data = {
+        "dep": os.path.join(workdir, "dep %s" % n_files),
+        "agnp": os.path.join(workdir, "agnp %s" % n_files),
+        "archive": os.path.join(workdir, "upload %s.zip" % n_files),
+    }
+    make_dep_layout(data["dep"], n_files, ccode, n_pixels, comma=comma)
+    make_agnp_layout(data["agnp"], n_files, ccode, n_pixels, comma=comma)
+    make_archive(data["agnp"], data["archive"])
+    return data
+
+
+def run_benchmark(
+    name: str, data: Dict[str, str], workdir: str, repeat: int
+) -> List[float]:
+    """Times of a benchmark on the generated data"""
+    import actions
+    import utils
+
+    src_dir = data["dep"] if name == "dep" else data["agnp"]
+    run_dir = os.path.join(workdir, "run")
+    try:
+        if name == "read_bwtek_with_ratio_correction":
+            files = actions.list_spectrum_files(src_dir)
+            return timeit(
+                lambda: [
+                    actions.read_bwtek_with_ratio_correction(f) for f in files
+                ],
+                repeat=repeat,
+            )
+        if name in (
+            "transform_bwtek",
+            "recalibrate_bwtek",
+            "dep",
+            "process_agnp_synthesis_experiments",
+        ):
+            action = getattr(actions, name)
+
+            def run(target_dir):
+                # Failed files would make the timings meaningless
+                failed = [f for f, ok in action(target_dir).items() if not ok]
+                if failed:
+                    raise RuntimeError("%s failed on %s" % (name, failed[0]))
+
+            return timeit(run, fresh_copy(src_dir, run_dir), repeat)
+        if name == "zipdir":
+            out = os.path.join(workdir, "result.zip")
+            return timeit(lambda: utils.zipdir(src_dir, out), repeat=repeat)
+        if name == "extract_file":
+            file_info = {
+                "userfile_id": 0,
+                "filename": os.path.basename(data["archive"]),
+                "file_extension": "zip",
+                "download_path": data["archive"],
+                "extract_path": run_dir,
+            }
+            return timeit(
+                lambda: list(
+                    utils.extract_file(
+                        None, 0, file_info, accept=actions.is_spectrum_file
+                    )
+                ),
+                repeat=repeat,
+            )
+        raise ValueError("Unknown benchmark: %s" % name)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def environment() -> Dict:
+    import numpy
+    import pandas
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL,
+        )
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": datetime.datetime.utcnow().isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+    }
+
+
+def compare(results: List[Dict], previous_path: str) -> None:
+    """Print min times of this run relative to a previous one"""
+    with open(previous_path) as fp:
+        previous = {
+            (r["name"], r["n_files"]): r for r in json.load(fp)["results"]
+        }
+    print("\n%-40s %8s %10s %10s %8s" % ("", "files", "before", "now", "x"))
+    for r in results:
+        before = previous.get((r["name"], r["n_files"]))
+        if before is None:
+            continue
+        print(
+            "%-40s %8s %9.3fs %9.3fs %8.2f"
+            % (
+                r["name"],
+                r["n_files"],
+                before["min"],
+                r["min"],
+                before["min"] / r["min"] if r["min"] else float("nan"),
+            )
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="10,100,500")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default=",".join(BENCHMARKS))
+    parser.add_argument("--dot-decimals", action="store_true")
+    parser.add_argument("--executor", default="serial")
+    parser.add_argument("--spectra-cache", action="store_true")
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",")
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    sizes = [int(size) for size in args.sizes.split(",")]
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR,
+        "results",
+        "%s.json" % datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"),
+    )
+    output = os.path.abspath(output)
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="ibcp-bench-")
+    try:
+        configure(workdir, args.executor, args.spectra_cache)
+        results = []
+        for n_files in sizes:
+            data = make_data(workdir, n_files, not args.dot_decimals)
+            archive_bytes = os.path.getsize(data["archive"])
+            for name in names:
+                times = run_benchmark(name, data, workdir, args.repeat)
+                results.append(
+                    {
+                        "name": name,
+                        "n_files": n_files,
+                        "archive_bytes": archive_bytes,
+                        "times": times,
+                        "min": min(times),
+                        "median": statistics.median(times),
+                        "per_file_ms": 1000 * min(times) / n_files,
+                    }
+                )
+                print(
+                    "%-40s %6s files: min %.3fs, median %.3fs"
+                    % (name, n_files, min(times), statistics.median(times))
+                )
+            for path in data.values():
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump(
+            {
+                "environment": environment(),
+                "options": vars(args),
+                "results": results,
+            },
+            fp,
+            indent=2,
+        )
+    print("Results are written to %s" % output)
+    if previous is not None:
+        compare(results, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Synthetic BWTek files and folder layouts of dep and agnp experiments"""
+
+import os
+import datetime
+import zipfile
+from typing import List, Optional
+
+import numpy as np
+
+# Laser wavelength (nm) of the spectrometers of the shipped ratio files
+LASERS = {"NLU": 785.0, "RSM": 1064.0, "RWN": 532.0, "SFG": 785.0}
+COLUMNS = [
+    "Pixel",
+    "Wavelength",
+    "Wavenumber",
+    "Raman Shift",
+    "Dark",
+    "Reference",
+    "Raw data #1",
+    "Dark Subtracted #1",
+]
+# Raman shift (cm-1), height and width of the peaks of generated spectra.
+# 1585 falls in the dep window, the others in the agnp analyte windows
+PEAKS = ((1000.0, 3000.0, 8.0), (1585.0, 5000.0, 12.0), (1710.0, 1500.0, 10.0))
+
+
+def ratio_pixels(ratio_files_dir: str, ccode: str) -> int:
+    """Number of pixels of the spectrometer of a ratio file"""
+    with open(os.path.join(ratio_files_dir, "%s.txt" % ccode)) as fp:
+        return sum(1 for line in fp if line.strip())
+
+
+def make_spectrum(
+    n_pixels: int, laser: float, rng: np.random.RandomState
+) -> np.ndarray:
+    """Table of a BWTek file: a row per pixel, COLUMNS as columns"""
+    pixel = np.arange(n_pixels, dtype=np.float64)
+    # A smooth pixel-to-wavelength calibration covering ~100-3200 cm-1
+    lo = 1e7 / (1e7 / laser - 100.0)
+    hi = 1e7 / (1e7 / laser - 3200.0)
+    x = pixel / max(n_pixels - 1, 1)
+    wavelength = lo + (hi - lo) * (x - 0.05 * x * (1 - x))
+    wavenumber = 1e7 / wavelength
+    raman_shift = 1e7 / laser - wavenumber
+
+    signal = 2000.0 + 1500.0 * np.exp(-raman_shift / 1500.0)
+    for center, height, width in PEAKS:
+        height *= rng.uniform(0.5, 1.5)
+        signal += height * np.exp(-0.5 * ((raman_shift - center) / width) ** 2)
+    dark = 1000.0 + rng.normal(0, 5, n_pixels)
+    raw = np.round(dark + signal + rng.normal(0, 20, n_pixels))
+    dark = np.round(dark)
+    reference = np.full(n_pixels, 50000.0)
+    return np.column_stack(
+        [
+            pixel,
+            wavelength,
+            wavenumber,
+            raman_shift,
+            dark,
+            reference,
+            raw,
+            raw - dark,
+        ]
+    )
+
+
+def write_bwtek_file(
+    path: str,
+    ccode: str = "NLU",
+    n_pixels: int = 2048,
+    date: Optional[datetime.datetime] = None,
+    comma: bool = True,
+    seed: int = 0,
+) -> None:
+    """Write a BWSpec-like file with a `c code` header and a Pixel table
+
+    `comma` switches between comma (Russian locale) and dot decimals.
+    """
+    rng = np.random.RandomState(seed)
+    table = make_spectrum(n_pixels, LASERS.get(ccode, 785.0), rng)
+    date = date or datetime.datetime(2019, 7, 22, 20, 5, 25)
+    header = [
+        "File Version;BWSpec4.03_21",
+        "Date;%s" % date.strftime("%Y-%m-%d %H:%M:%S"),
+        "title;BWS465-785S",
+        "model;BTC665N",
+        "c code;%s" % ccode,
+        "laser_wavelength;%s" % LASERS.get(ccode, 785.0),
+        "integration times(ms);1000",
+        ";".join(COLUMNS) + ";",
+    ]
+    lines = [";".join("%.4f" % value for value in row) + ";" for row in table]
+    if comma:
+        lines = [line.replace(".", ",") for line in lines]
+    text = "\r\n".join(header + lines) + "\r\n"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as fp:
+        fp.write(text)
+
+
+def make_dep_layout(
+    root: str,
+    n_files: int,
+    ccode: str = "NLU",
+    n_pixels: int = 2048,
+    n_experiments: int = 2,
+    folders_per_experiment: int = 2,
+    comma: bool = True,
+) -> List[str]:
+    """Files of dep experiments: `<root>/<experiment>/<folder>/<n>.txt`
+
+    Spectra of a folder are taken one second apart.
+    """
+    paths = []
+    n_folders = n_experiments * folders_per_experiment
+    start = datetime.datetime(2019, 7, 22, 20, 0, 0)
+    for i in range(n_files):
+        folder = i % n_folders
+        path = os.path.join(
+            root,
+            "experiment_%s" % (folder // folders_per_experiment + 1),
+            "point_%s" % (folder % folders_per_experiment + 1),
+            "%04d.txt" % (i // n_folders),
+        )
+        write_bwtek_file(
+            path,
+            ccode,
+            n_pixels,
+            date=start + datetime.timedelta(seconds=i // n_folders),
+            comma=comma,
+            seed=i,
+        )
+        paths.append(path)
+    return paths
+
+
+def make_agnp_layout(
+    root: str,
+    n_files: int,
+    ccode: str = "NLU",
+    n_pixels: int = 2048,
+    n_folders: int = 2,
+    comma: bool = True,
+) -> List[str]:
+    """Files of AgNP synthesis experiments
+
+    `<root>/<folder>/SP_<n> <analyte> <concentration> AgNP N<synthesis>.txt`
+    cycling over the analytes, concentrations and syntheses of the bot.
+    """
+    analytes = ("NaAc", "NaAc_x", "NaAc_ap")
+    concentrations = ("0_1", "1_0", "10")
+    paths = []
+    for i in range(n_files):
+        sp = i // n_folders + 1
+        name = "SP_%s %s %s AgNP N%s.txt" % (
+            sp,
+            analytes[sp % len(analytes)],
+            concentrations[(sp // len(analytes)) % len(concentrations)],
+            sp % 3 + 1,
+        )
+        path = os.path.join(root, "synthesis_%s" % (i % n_folders + 1), name)
+        write_bwtek_file(path, ccode, n_pixels, comma=comma, seed=i)
+        paths.append(path)
+    return paths
+
+
+def make_archive(src_dir: str, archive_path: str) -> int:
+    """Zip a directory like users do and return the archive size"""
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for root, dirs, files in os.walk(src_dir):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                zipf.write(path, os.path.relpath(path, src_dir))
+    return os.path.getsize(archive_path)
@@ -10,13 +10,30 @@ from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler
 from telegram.ext.filters import Filters
 
 # OWN
-from models import UserFiles
-from utils import get_file_info, remove_extension, extract_file, zipdir
+from models import Jobs
+from utils import (
+    get_file_info,
+    remove_extension,
+    download_file,
+    extract_file,
+    extract_to_memory,
+    zipdir,
+    zip_memory_dir,
+    ArchiveError,
+)
+from jobs import NonRetryableJobError
+from cache import cache_key
+from tracing import Trace
+from metrics import job_metrics
 from actions import (
     transform_bwtek,
     recalibrate_bwtek,
     dep,
     process_agnp_synthesis_experiments,
+    get_ratio_version,
+    is_spectrum_file,
+    run_pipeline,
+    user_experiments,
 )
 
 ACTIONS_MAPPING = {
@@ -25,11 +42,29 @@ ACTIONS_MAPPING = {
     "dep": dep,
     "agnp": process_agnp_synthesis_experiments,
 }
+ACTION_TITLES = {
+    "trans": "Переформатировать BWTek в txt (два столбца)",
+    "recal": "Рекалибровать BWTek",
+    "dep": "Посчитать для ДЭФ",
+    "agnp": "Обработать результаты по синтезу частиц",
+}
+# Several actions of a job are joined by this separator, e.g. "recal+dep"
+ACTIONS_SEPARATOR = "+"
+# Actions which results depend on the ratio files
+RATIO_ACTIONS = ("recal", "dep", "agnp")
+# Bump when the content or the format of action results change, so the
+# results cached before are not served, see result_cache_key
+RESULTS_VERSION = "1"
+# Ratio files version seen by the last job, see result_cache_key
+_ratio_versions = {}
 
 # Set globals
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(BASEDIR, ".env"))
 TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
+# Bot API server, e.g. a local one or a fake one for tests (empty for
+# the official https://api.telegram.org)
+BOT_API_URL = os.environ.get("TELEGRAM_BOT_API_URL", "").rstrip("/")
 
 # Set logger
 logger = logging.getLogger("IBCP-BOT")
@@ -41,6 +76,13 @@ formatter = logging.Formatter(
 )
 fh.setFormatter(formatter)
 logger.addHandler(fh)
+# Job traces go to a separate log as JSON lines, see tracing
+trace_fh = logging.FileHandler("ibcp-bot-trace.log")
+trace_fh.setLevel(logging.INFO)
+trace_fh.setFormatter(logging.Formatter("%(message)s"))
+trace_logger = logging.getLogger("IBCP-BOT.trace")
+trace_logger.addHandler(trace_fh)
+trace_logger.propagate = False
 
 
 # ===== COMMANDS =====
@@ -78,9 +120,86 @@ def unknown(bot, update):
     return "OK"
 
 
+# ===== ADMIN COMMANDS =====
+def is_admin(update):
+    from app import app
+
+    return update.message.from_user.id in app.config["ADMIN_IDS"]
+
+
+def parse_job_id(bot, update, args, command):
+    """Job id of the command or None, the usage is sent if it is missing"""
+    try:
+        return int(args[0])
+    except (IndexError, ValueError):
+        bot.send_message(
+            chat_id=update.message.chat.id,
+            text="Укажите номер задачи, например: /%s 42" % command,
+        )
+        return None
+
+
+def profile_job(bot, update, args):
+    """Admin command: run the job once again under the profiler"""
+    from app import job_queue
+
+    logger.debug("Got profile command: %s" % update)
+    if not is_admin(update):
+        return unknown(bot, update)
+    job_id = parse_job_id(bot, update, args, "profile")
+    if job_id is None:
+        return "OK"
+    job = job_queue.mark_for_profiling(job_id)
+    if job is None:
+        text = "Задача %s не найдена" % job_id
+    elif not job.profile:
+        text = (
+            "Задача %s сейчас выполняется. Повторите команду, "
+            "когда она завершится" % job_id
+        )
+    else:
+        text = (
+            "Задача %s будет выполнена с профилированием. "
+            "Профиль можно будет получить командой /getprofile %s"
+            % (job_id, job_id)
+        )
+    bot.send_message(chat_id=update.message.chat.id, text=text)
+    return "OK"
+
+
+def get_job_profile(bot, update, args):
+    """Admin command: send the cProfile stats of the job"""
+    from app import app, db
+
+    logger.debug("Got getprofile command: %s" % update)
+    if not is_admin(update):
+        return unknown(bot, update)
+    job_id = parse_job_id(bot, update, args, "getprofile")
+    if job_id is None:
+        return "OK"
+    chat_id = update.message.chat.id
+    with app.app_context():
+        job = db.session.query(Jobs).get(job_id)
+        profile_path = job.profile_path if job is not None else None
+    if profile_path is None or not os.path.isfile(profile_path):
+        bot.send_message(
+            chat_id=chat_id,
+            text="Профиля задачи %s нет. Запросите его командой /profile %s"
+            % (job_id, job_id),
+        )
+        return "OK"
+    with open(profile_path, "rb") as document:
+        bot.send_document(
+            chat_id=chat_id,
+            document=document,
+            filename=os.path.basename(profile_path),
+        )
+    return "OK"
+
+
 # ===== DOCUMENTS =====
 def choose_document_action(bot, update):
-    from app import app, db
+    from app import userfiles
 
     logger.debug("Got a message with document: %s" % update)
     chat_id = update.message.chat.id
@@ -99,46 +218,32 @@ def choose_document_action(bot, update):
         )
         return "OK"
 
-    userfile = UserFiles(
+    logger.debug("Creating userfile...")
+    userfile = userfiles.add(
         user_id=update.message.from_user.id,
         chat_id=chat_id,
         message_id=msg_id,
         file_id=update.message.document.file_id,
         file_name=update.message.document.file_name,
     )
-    logger.debug("Creating userfile...")
-    with app.app_context():
-        db.session.add(userfile)
-        db.session.commit()
-        logger.debug("Created a record for user file: %s" % userfile)
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "Переформатировать BWTek в txt (два столбца)",
-                    callback_data='{"action":"trans", "uf":"%s"}'
-                    % userfile.id,
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "Рекалибровать BWTek",
-                    callback_data='{"action":"recal", "uf":"%s"}'
-                    % userfile.id,
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "Посчитать для ДЭФ",
-                    callback_data='{"action":"dep", "uf":"%s"}' % userfile.id,
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "Обработать результаты по синтезу частиц",
-                    callback_data='{"action":"agnp", "uf":"%s"}' % userfile.id,
-                )
-            ],
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                title,
+                callback_data='{"action":"%s", "uf":"%s"}'
+                % (action, userfile.id),
+            )
         ]
+        for action, title in ACTION_TITLES.items()
+    ]
+    keyboard.append(
+        [
+            InlineKeyboardButton(
+                "Выбрать несколько действий",
+                callback_data='{"select":0, "uf":"%s"}' % userfile.id,
+            )
+        ]
+    )
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -149,9 +254,51 @@ def choose_document_action(bot, update):
     return "OK"
 
 
+def multi_action_keyboard(userfile_id, selected):
+    """Keyboard to toggle several actions and run them together
+
+    `selected` is a bit mask of the selected actions in ACTION_TITLES
+    order. It is kept in the callback data of the buttons (Telegram
+    limits it to 64 bytes), so nothing is stored between clicks.
+    """
+    keyboard = []
+    chosen = []
+    for i, (action, title) in enumerate(ACTION_TITLES.items()):
+        if selected & (1 << i):
+            chosen.append(action)
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    ("✅ " if selected & (1 << i) else "⬜ ") + title,
+                    callback_data='{"select":%s, "uf":"%s"}'
+                    % (selected ^ (1 << i), userfile_id),
+                )
+            ]
+        )
+    if chosen:
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    "Запустить 🚀",
+                    callback_data='{"action":"%s", "uf":"%s"}'
+                    % (ACTIONS_SEPARATOR.join(chosen), userfile_id),
+                )
+            ]
+        )
+    return InlineKeyboardMarkup(keyboard)
+
+
+def parse_job_action(action):
+    """Canonical job action of one or several actions or None if invalid"""
+    names = (action or "").split(ACTIONS_SEPARATOR)
+    if not all(name in ACTIONS_MAPPING for name in names):
+        return None
+    return ACTIONS_SEPARATOR.join(a for a in ACTIONS_MAPPING if a in names)
+
+
 # ===== INLINE BUTTONS =====
 def inline_buttons_handler(bot, update):
-    from app import app, db
+    from app import job_queue
 
     query = update.callback_query
     chat_id = query.message.chat_id
@@ -163,6 +310,7 @@ def inline_buttons_handler(bot, update):
         params = json.loads(query.data)
         action = params.get("action")
         userfile_id = int(params.get("uf"))
+        selected = params.get("select")
     except Exception as e:
         logger.error(e)
         bot.send_message(
@@ -178,66 +326,40 @@ def inline_buttons_handler(bot, update):
         )
         raise
 
-    # Try to get info about file from db
-    file_info = get_file_info(bot, userfile_id)
-    if action in ACTIONS_MAPPING:
-        outfile = os.path.join(
-            app.config["PROCESSED_DIR"],
-            "%s %s %s.zip"
-            % (
-                remove_extension(file_info["filename"]),
-                file_info["userfile_id"],
-                action,
-            ),
+    if selected is not None:
+        # Multi-select mode: only redraw the keyboard
+        bot.edit_message_reply_markup(
+            chat_id=chat_id,
+            message_id=query.message.message_id,
+            reply_markup=multi_action_keyboard(userfile_id, int(selected)),
         )
-        bot.send_message(text="Сейчас посмотрю...⏳", chat_id=chat_id)
-        try:
-            extract_file(bot, chat_id, file_info)
-            statuses = ACTIONS_MAPPING[action](file_info["extract_path"])
-
-            if any(statuses.values()):
-                zipdir(file_info["extract_path"], outfile)
-                bot.send_message(chat_id=chat_id, text="Готово!🚀")
-                bot.send_document(
-                    chat_id=chat_id,
-                    document=open(outfile, "rb"),
-                    filename=os.path.basename(outfile),
-                    reply_to_message_id=file_info["message_id"],
-                )
-                if not all(statuses.values()):
-                    message = "⚠️ Следующие файлы не удалось обработать: ⚠️\n"
-                    for file, status in statuses.items():
-                        if not status:
-                            file_path = os.path.relpath(
-                                file, file_info["extract_path"]
-                            )
-                            # Telegram has limit for message length, so we
-                            # split the message in case it is too long (> 4096)
-                            if len(message) + len(file_path) + 10 < 4096:
-                                message += f"\n ❌ {file_path}"
-                            else:
-                                bot.send_message(chat_id=chat_id, text=message)
-                                message = f" ❌ {file_path}"
-                    bot.send_message(chat_id=chat_id, text=message)
-            else:
-                bot.send_message(
-                    chat_id=chat_id,
-                    text="Не удалось обработать данные. Проверьте, что файлы предоставлены в нужном формате.",
+        return "OK"
+
+    action = parse_job_action(action)
+    if action is not None:
+        # The action is run by the job queue workers, so the webhook
+        # returns right away. Repeated clicks attach to the same job.
+        job, queued = job_queue.enqueue(
+            userfile_id=userfile_id,
+            action=action,
+            user_id=query.from_user.id,
+            chat_id=chat_id,
+        )
+        if job.state == "done" and not queued:
+            if job.result_path and os.path.isfile(job.result_path):
+                send_result(
+                    bot, chat_id, job.result_path, userfile_id, action=action
                 )
-        except Exception as e:
-            logger.error(e)
+                return "OK"
+            queued = job_queue.requeue(job)
+        if queued:
+            bot.send_message(text="Сейчас посмотрю...⏳", chat_id=chat_id)
+        else:
             bot.send_message(
+                text="Уже обрабатываю этот файл, пришлю результат, "
+                "как только он будет готов ⏳",
                 chat_id=chat_id,
-                text="\n".join(
-                    [
-                        "Упс! Что-то пошло не так 😱",
-                        "Передайте это администратору, чтобы он все исправил:",
-                        "Query data: %s" % query.data,
-                        "Exception: %s" % e,
-                    ]
-                ),
             )
-            raise
     else:
         bot.send_message(
             chat_id=chat_id,
@@ -246,11 +368,336 @@ def inline_buttons_handler(bot, update):
     return "OK"
 
 
+# ===== JOBS =====
+class JobBot(object):
+    """Bot of a job run which records whether the user got any message
+
+    Chat actions are not counted, they are not seen once the job is over.
+    A `silent` bot drops all messages, e.g. for reruns of jobs profiled by
+    admins, which the user has got the result of already.
+    """
+
+    def __init__(self, bot, silent=False):
+        self._bot = bot
+        self.silent = silent
+        self.sent = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._bot, name)
+        if not name.startswith(("send_", "edit_")):
+            return attr
+        if self.silent:
+            return lambda *args, **kwargs: None
+        if name == "send_chat_action":
+            return attr
+
+        def call(*args, **kwargs):
+            # A request that failed may still have been delivered
+            self.sent = True
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def process_job(job):
+    """Run the job action on the user file and send the result back
+
+    Returns the path of the result zip, if any. Durations of the job
+    stages are traced, see tracing.Trace. Jobs which failed after the user
+    got a message are not retried, so that messages are not repeated.
+    """
+    trace = Trace(job.id, job.action)
+    job_bot = JobBot(bot, silent=job.profile)
+    status = "error"
+    try:
+        result, status = _process_job(job, job_bot, trace)
+        return result
+    except NonRetryableJobError:
+        raise
+    except Exception as e:
+        if job_bot.sent:
+            raise NonRetryableJobError(e) from e
+        raise
+    finally:
+        job_metrics.observe_trace(trace.finish(status))
+
+
+def _process_job(job, bot, trace):
+    """Returns the result path and the trace status of the job"""
+    from app import app, result_cache
+
+    chat_id = job.chat_id
+    with trace.stage("get_file_info"):
+        file_info = get_file_info(bot, job.userfile_id)
+    # Different actions on the same file must not share the extract dir
+    file_info["extract_path"] = "%s %s" % (
+        file_info["extract_path"],
+        job.action,
+    )
+    outfile = os.path.join(
+        app.config["PROCESSED_DIR"],
+        "%s %s %s.zip"
+        % (
+            remove_extension(file_info["filename"]),
+            file_info["userfile_id"],
+            job.action,
+        ),
+    )
+    in_memory = use_memory_processing(file_info)
+    try:
+        with trace.stage("download", bytes=file_info["file_size"]):
+            content_hash = download_file(
+                bot, chat_id, file_info, in_memory=in_memory
+            )
+    except ValueError as e:
+        # The user has already been told that the file is not supported
+        raise NonRetryableJobError(e)
+
+    # The same content processed by the same action gives the same result
+    key, meta = result_cache_key(
+        content_hash,
+        job.action,
+        # A single txt file is archived under its own name
+        filename=(
+            file_info["filename"]
+            if file_info["file_extension"] == "txt"
+            else None
+        ),
+    )
+    # Profiled jobs must run the action, not send the cached result
+    cached = None if job.profile else result_cache.get(key)
+    if cached is not None:
+        logger.debug("Result cache hit for job %s: %s" % (job.id, cached))
+        with trace.stage("send_document", bytes=os.path.getsize(cached)):
+            send_result(
+                bot,
+                chat_id,
+                cached,
+                job.userfile_id,
+                file_info["message_id"],
+                filename=os.path.basename(outfile),
+            )
+        report_failed_files(bot, chat_id, result_cache.meta(key).get("failed"))
+        return cached, "cached"
+
+    try:
+        if in_memory:
+            with trace.stage("extract") as info:
+                target = extract_to_memory(
+                    bot, chat_id, file_info, accept=is_spectrum_file
+                )
+                info["files"] = len(target)
+            files = None
+        else:
+            # Only files the actions read are extracted, and they are passed
+            # to the action while the archive is still being unpacked
+            target = file_info["extract_path"]
+            files = trace.iterate(
+                "extract",
+                extract_file(bot, chat_id, file_info, accept=is_spectrum_file),
+            )
+        names = job.action.split(ACTIONS_SEPARATOR)
+        with trace.stage("action") as info, user_experiments(job.user_id):
+            if len(names) == 1:
+                statuses = ACTIONS_MAPPING[job.action](target, files=files)
+            else:
+                # Extract and parse once, results of all actions in one zip
+                statuses = run_pipeline(
+                    target,
+                    {name: ACTIONS_MAPPING[name] for name in names},
+                    files=files,
+                )
+            info["files"] = len(statuses)
+            info["failed"] = sum(not ok for ok in statuses.values())
+    except ArchiveError as e:
+        # The user has already been told that the archive is broken
+        raise NonRetryableJobError(e)
+
+    if any(statuses.values()):
+        meta["failed"] = [
+            os.path.relpath(file, file_info["extract_path"])
+            for file, status in statuses.items()
+            if not status
+        ]
+        zip_options = {
+            "level": app.config["RESULT_ZIP_LEVEL"],
+            "workers": app.config["RESULT_ZIP_WORKERS"],
+        }
+        with trace.stage("zip") as info:
+            if in_memory:
+                # The zip goes to the result cache only, it is sent from there
+                result = result_cache.put_bytes(
+                    key, zip_memory_dir(target, **zip_options), meta
+                )
+            else:
+                zipdir(file_info["extract_path"], outfile, **zip_options)
+                result_cache.put(key, outfile, meta)
+                result = outfile
+            info["bytes"] = os.path.getsize(result)
+        with trace.stage("send_document", bytes=info["bytes"]):
+            send_result(
+                bot,
+                chat_id,
+                result,
+                job.userfile_id,
+                file_info["message_id"],
+                filename=os.path.basename(outfile),
+            )
+        report_failed_files(bot, chat_id, meta["failed"])
+        return result, "done"
+    else:
+        bot.send_message(
+            chat_id=chat_id,
+            text="Не удалось обработать данные. Проверьте, что файлы предоставлены в нужном формате.",
+        )
+    return None, "no_result"
+
+
+def use_memory_processing(file_info):
+    """Whether the user file is small enough to be processed in memory"""
+    from app import app
+
+    file_size = file_info["file_size"]
+    return (
+        app.config["IN_MEMORY_PROCESSING"]
+        and file_info["file_extension"] in ("txt", "zip")
+        and file_size is not None
+        and file_size <= app.config["IN_MEMORY_MAX_BYTES"]
+    )
+
+
+def result_cache_key(content_hash, action, filename=None):
+    """Result cache key and metadata of the action run on the content
+
+    `filename` is given when the result contains the name of the uploaded
+    file, so the same content uploaded under another name is not served
+    a result with the old name.
+    """
+    from app import app, result_cache
+
+    meta = {
+        "content_hash": content_hash,
+        "action": action,
+        "results_version": RESULTS_VERSION,
+        # Results differ by the columnar output settings
+        "output": "%s:%s"
+        % (
+            app.config["BATCH_OUTPUT_FORMAT"],
+            app.config["BATCH_OUTPUT_KEEP_TXT"],
+        ),
+    }
+    if any(name in RATIO_ACTIONS for name in action.split(ACTIONS_SEPARATOR)):
+        meta["ratio_version"] = ratio_version = get_ratio_version()
+        # Results computed with other ratio files are not valid anymore
+        if ratio_version != _ratio_versions.get("last", ratio_version):
+            removed = result_cache.invalidate(
+                lambda m: m.get("ratio_version") not in (None, ratio_version)
+            )
+            logger.warning(
+                "Ratio files changed, removed %s cached results" % removed
+            )
+        _ratio_versions["last"] = ratio_version
+    if filename is not None:
+        meta["filename"] = filename
+    return (
+        cache_key(
+            content_hash,
+            action,
+            RESULTS_VERSION,
+            meta["output"],
+            meta.get("ratio_version", ""),
+            meta.get("filename", ""),
+        ),
+        meta,
+    )
+
+
+def report_failed_files(bot, chat_id, failed):
+    """Send the list of files which could not be processed, if any"""
+    if not failed:
+        return
+    message = "⚠️ Следующие файлы не удалось обработать: ⚠️\n"
+    for file_path in failed:
+        # Telegram has limit for message length, so we
+        # split the message in case it is too long (> 4096)
+        if len(message) + len(file_path) + 10 < 4096:
+            message += f"\n ❌ {file_path}"
+        else:
+            bot.send_message(chat_id=chat_id, text=message)
+            message = f" ❌ {file_path}"
+    bot.send_message(chat_id=chat_id, text=message)
+
+
+def send_result(
+    bot,
+    chat_id,
+    outfile,
+    userfile_id,
+    message_id=None,
+    filename=None,
+    action=None,
+):
+    """Send a result zip in reply to the user file message
+
+    If `message_id` is not given, it is taken from the database along with
+    the default file name of the `action` result.
+    """
+    if message_id is None:
+        from app import userfiles
+
+        userfile = userfiles.get(userfile_id)
+        message_id = userfile.message_id
+        if filename is None and action is not None:
+            filename = "%s %s %s.zip" % (
+                remove_extension(userfile.file_name),
+                userfile_id,
+                action,
+            )
+    bot.send_message(chat_id=chat_id, text="Готово!🚀")
+    with open(outfile, "rb") as document:
+        bot.send_document(
+            chat_id=chat_id,
+            document=document,
+            filename=filename or os.path.basename(outfile),
+            reply_to_message_id=message_id,
+        )
+
+
+def notify_job_failure(job, error):
+    """Tell the user that the job failed after all attempts"""
+    if job.profile:
+        # The user has not asked for the profiled rerun
+        logger.warning("Profiled job %s failed: %s" % (job.id, error))
+        return
+    bot.send_message(
+        chat_id=job.chat_id,
+        text="\n".join(
+            [
+                "Упс! Что-то пошло не так 😱",
+                "Передайте это администратору, чтобы он все исправил:",
+                "Job: %s" % job.id,
+                "Action: %s, user file: %s" % (job.action, job.userfile_id),
+                "Exception: %s" % error,
+            ]
+        ),
+    )
+
+
 # ===== SET HANDLERS =====
-bot = telegram.Bot(TOKEN)
+bot = telegram.Bot(
+    TOKEN,
+    base_url=BOT_API_URL + "/bot" if BOT_API_URL else None,
+    base_file_url=BOT_API_URL + "/file/bot" if BOT_API_URL else None,
+)
 updater = telegram.ext.Updater(bot=bot)
 updater.dispatcher.add_handler(CommandHandler("help", start))
 updater.dispatcher.add_handler(CommandHandler("start", start))
+updater.dispatcher.add_handler(
+    CommandHandler("profile", profile_job, pass_args=True)
+)
+updater.dispatcher.add_handler(
+    CommandHandler("getprofile", get_job_profile, pass_args=True)
+)
 updater.dispatcher.add_handler(
     MessageHandler(Filters.document, callback=choose_document_action)
 )
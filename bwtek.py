@@ -0,0 +1,155 @@
+import io
+import re
+import hashlib
+import logging
+from typing import BinaryIO, Dict, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from cache import DiskLRUCache, cache_key
+
+logger = logging.getLogger("IBCP-BOT")
+
+DEFAULT_COLUMNS = ("Pixel", "Raman Shift", "Dark", "Raw data #1")
+NA_VALUES = ("", " ", "  ", "   ", "    ")
+
+
+class BWTekFile(NamedTuple):
+    """Parsed BWTek file
+
+    `metadata` holds the header rows (`<key>;<value>`) and `data` holds
+    the requested numeric columns as float arrays.
+    """
+
+    metadata: Dict[str, str]
+    data: Dict[str, np.ndarray]
+
+    @property
+    def ccode(self) -> str:
+        return self.metadata["c code"]
+
+
+def parse_bwtek(
+    source: Union[str, bytes, BinaryIO],
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+) -> BWTekFile:
+    """Parse a BWTek file reading it exactly once
+
+    `source` is a path, raw file content or a binary file-like object.
+    Only `columns` of the data table are converted to numbers.
+    """
+    text = read_source(source).decode("utf-8", errors="replace")
+
+    if not text.startswith("File Version;BWSpec"):
+        raise TypeError(
+            "Incorrect BWTek file format. The first row does "
+            "not match 'File Version;BWSpec<...>'"
+        )
+
+    # Split header and data table
+    table_start = text.find("\nPixel;")
+    if table_start < 0:
+        raise TypeError(
+            "Incorrect BWTek file format. Could not to find a "
+            "row starting with 'Pixel;'"
+        )
+    metadata = _parse_header(text[:table_start])
+    if "c code" not in metadata:
+        raise TypeError(
+            "Incorrect BWTek file format. 'c code' value was not found"
+        )
+    table = text[table_start + 1 :]
+
+    # Get decimal delimiter from the first data line
+    header_end = table.find("\n")
+    first_data_line = table[header_end + 1 :].split("\n", 1)[0].strip()
+    decimal_del = set(re.sub("[0-9; -]", "", first_data_line))
+    if not (len(decimal_del) == 1 and decimal_del <= {",", "."}):
+        raise TypeError(
+            "Incorrect BWTek file format. Could not to find the decimal delimiter"
+        )
+
+    # Fast path for comma decimals: ';' is the only field separator, so all
+    # commas in the data lines are decimal ones and can be replaced in one
+    # pass (column names are kept as they are). This keeps the C parser on
+    # its default (fastest) float conversion.
+    if decimal_del == {","}:
+        table = table[: header_end + 1] + table[header_end + 1 :].replace(
+            ",", "."
+        )
+
+    available = [c.strip() for c in table[:header_end].split(";")]
+    missing = [c for c in columns if c not in available]
+    if missing:
+        raise TypeError(
+            "Incorrect BWTek file format. Missing columns: %s"
+            % ", ".join(missing)
+        )
+    df = pd.read_csv(
+        io.StringIO(table),
+        sep=";",
+        usecols=list(columns),
+        na_values=NA_VALUES,
+        dtype=np.float64,
+        engine="c",
+    )
+    return BWTekFile(
+        metadata=metadata, data={c: df[c].values for c in columns}
+    )
+
+
+def parse_bwtek_cached(
+    source: Union[str, bytes, BinaryIO],
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+    cache: Optional[DiskLRUCache] = None,
+) -> BWTekFile:
+    """`parse_bwtek` through an on-disk cache of parsed files
+
+    Entries are keyed by SHA-256 of the raw file content and the columns:
+    the same file uploaded again (or processed by another action) is not
+    parsed again. Columns are stored as a npz file and the header as the
+    entry metadata. Without `cache` this is just `parse_bwtek`.
+    """
+    if cache is None:
+        return parse_bwtek(source, columns)
+    raw = read_source(source)
+    key = cache_key(hashlib.sha256(raw).hexdigest(), *columns)
+    path = cache.get(key)
+    if path is not None:
+        try:
+            with np.load(path) as npz:
+                data = {c: npz[c] for c in columns}
+            metadata = cache.meta(key)
+            if "c code" in metadata:
+                return BWTekFile(metadata=metadata, data=data)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(
+                "Broken parsed spectrum cache entry %s: %s" % (key, e)
+            )
+        cache.remove(key)
+
+    parsed = parse_bwtek(raw, columns)
+    buffer = io.BytesIO()
+    np.savez(buffer, **parsed.data)
+    cache.put_bytes(key, buffer.getvalue(), meta=parsed.metadata)
+    return parsed
+
+
+def read_source(source: Union[str, bytes, BinaryIO]) -> bytes:
+    """Raw content of a path, bytes or a binary file-like object"""
+    if isinstance(source, str):
+        with open(source, "rb") as fp:
+            return fp.read()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    return source.read()
+
+
+def _parse_header(header: str) -> Dict[str, str]:
+    metadata = {}
+    for line in header.splitlines():
+        key, sep, value = line.partition(";")
+        if sep and key.strip():
+            metadata[key.strip()] = value.split(";")[0].strip()
+    return metadata
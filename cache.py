@@ -0,0 +1,204 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger("IBCP-BOT")
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 hex digest of a file content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Hard link `src` to the new path `dst`, copy it across file systems
+
+    Linked files share their content, so neither may be changed in place.
+    """
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def cache_key(*parts: str) -> str:
+    """Build a file-name safe cache key from several parts"""
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class DiskLRUCache(object):
+    """Size-bounded on-disk cache of files
+
+    Every entry is a `<key><suffix>` file plus a `<key>.json` file with
+    arbitrary metadata. File modification time is used as the last access
+    time, so the least recently used entries are evicted first once the
+    total size exceeds `max_bytes`, down to the `low_watermark` fraction of
+    it so that the following puts do not scan the directory again. Entries
+    are written to a temporary file and renamed, so readers never see
+    partial files, even from other processes.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        suffix: str = "",
+        low_watermark: float = 0.9,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.low_watermark = low_watermark
+        self._lock = threading.Lock()
+        # Estimated total size, see _commit
+        self._size = None  # type: Optional[int]
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str) -> Optional[str]:
+        """Path of the cached file or None"""
+        path = self.path(key)
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def meta(self, key: str) -> Dict:
+        try:
+            with open(self._meta_path(key), "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def put(
+        self, key: str, src_path: str, meta: Optional[Dict] = None
+    ) -> str:
+        """Copy a file to the cache and return its cached path"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, ".%s.tmp" % uuid.uuid4().hex)
+        shutil.copyfile(src_path, tmp)
+        return self._commit(key, tmp, meta)
+
+    def put_link(
+        self, key: str, src_path: str, meta: Optional[Dict] = None
+    ) -> str:
+        """Like `put`, but hard links the file if possible, see link_or_copy
+
+        The file must not be changed in place afterwards.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, ".%s.tmp" % uuid.uuid4().hex)
+        link_or_copy(src_path, tmp)
+        return self._commit(key, tmp, meta)
+
+    def put_bytes(
+        self, key: str, content: bytes, meta: Optional[Dict] = None
+    ) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, ".%s.tmp" % uuid.uuid4().hex)
+        with open(tmp, "wb") as fp:
+            fp.write(content)
+        return self._commit(key, tmp, meta)
+
+    def _commit(self, key: str, tmp: str, meta: Optional[Dict]) -> str:
+        if meta is not None:
+            tmp_meta = tmp + ".json"
+            with open(tmp_meta, "w") as fp:
+                json.dump(meta, fp)
+            os.replace(tmp_meta, self._meta_path(key))
+        path = self.path(key)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        # The directory is scanned only when the estimated size exceeds the
+        # limit, not on every put (other processes may add entries too, so
+        # the estimate is refreshed by every scan)
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            scan = self._size is None or self._size > self.max_bytes
+        if scan:
+            self.evict()
+        return path
+
+    def remove(self, key: str) -> None:
+        for path in (self.path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def invalidate(self, predicate: Callable[[Dict], bool]) -> int:
+        """Remove entries which metadata matches the predicate"""
+        removed = 0
+        for key in self._keys():
+            if predicate(self.meta(key)):
+                self.remove(key)
+                removed += 1
+        return removed
+
+    def evict(self) -> None:
+        """Remove least recently used entries if the cache is too big
+
+        Once over `max_bytes`, entries are removed until the total is below
+        the low watermark.
+        """
+        with self._lock:
+            entries = []
+            for key in self._keys():
+                try:
+                    stat = os.stat(self.path(key))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, key))
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                target = int(self.max_bytes * self.low_watermark)
+            else:
+                target = self.max_bytes
+            for _, size, key in sorted(entries):
+                if total <= target:
+                    break
+                logger.debug("Evicting cache entry %s" % key)
+                self.remove(key)
+                total -= size
+            self._size = total
+
+    def _keys(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [
+            name[: -len(self.suffix)] if self.suffix else name
+            for name in names
+            if not name.startswith(".")
+            and not name.endswith(".json")
+            and name.endswith(self.suffix)
+        ]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
@@ -13,16 +13,96 @@ class Config(object):
     SECRET_KEY = os.environ["SECRET_KEY"]
     SQLALCHEMY_DATABASE_URI = os.environ["DATABASE_URL"]
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # Connections are shared by the webhook threads and the job workers.
+    # SQLite databases are not pooled by SQLAlchemy
+    SQLALCHEMY_ENGINE_OPTIONS = (
+        {}
+        if SQLALCHEMY_DATABASE_URI.startswith("sqlite")
+        else {
+            "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+            "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 5)),
+            "pool_timeout": 30,
+            "pool_recycle": 1800,
+            "pool_pre_ping": True,
+        }
+    )
+    # User file records kept in memory, see repository.UserFileRepository
+    USERFILE_CACHE_SIZE = int(os.environ.get("USERFILE_CACHE_SIZE", 1024))
     BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
     TMP_DIR = os.path.join(BASEDIR, "tmp")
     DOWLOAD_DIR = os.path.join(BASEDIR, "downloads")
     PROCESSED_DIR = os.path.join(BASEDIR, "processed_files")
     RATIO_FILES_DIR = os.path.join(BASEDIR, "ratio_files")
+    # Process small zip and txt files without writing them to disk
+    IN_MEMORY_PROCESSING = os.environ.get("IN_MEMORY_PROCESSING", "0") == "1"
+    IN_MEMORY_MAX_BYTES = int(
+        os.environ.get("IN_MEMORY_MAX_BYTES", 20 * 1024 * 1024)
+    )
+    # Results of actions by content of the user file
+    RESULT_CACHE_DIR = os.path.join(PROCESSED_DIR, "cache")
+    RESULT_CACHE_MAX_BYTES = int(
+        os.environ.get("RESULT_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+    )
+    # getFile results are reused while their download links are valid
+    # (Telegram guarantees at least an hour)
+    TELEGRAM_FILE_TTL = float(os.environ.get("TELEGRAM_FILE_TTL", 3000))
+    # Downloaded user files by content, hard linked to the downloads
+    DOWNLOAD_CACHE_DIR = os.path.join(DOWLOAD_DIR, "cache")
+    DOWNLOAD_CACHE_MAX_BYTES = int(
+        os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+    )
+    # Parsed spectrum files by content (0 to turn off)
+    SPECTRA_CACHE_DIR = os.path.join(PROCESSED_DIR, "spectra_cache")
+    SPECTRA_CACHE_MAX_BYTES = int(
+        os.environ.get("SPECTRA_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+    )
+    # Also write all spectra of a job to one "parquet", "feather" or "npz"
+    # file (empty to turn off; parquet and feather need pyarrow), next to or
+    # instead of the *.txt files
+    BATCH_OUTPUT_FORMAT = os.environ.get("BATCH_OUTPUT_FORMAT", "")
+    BATCH_OUTPUT_KEEP_TXT = os.environ.get("BATCH_OUTPUT_KEEP_TXT", "1") == "1"
+    # Deflate level of result zips (0 stores files as is) and number of
+    # threads compressing them (0 for up to 4 by the number of CPUs)
+    RESULT_ZIP_LEVEL = int(os.environ.get("RESULT_ZIP_LEVEL", 6))
+    RESULT_ZIP_WORKERS = int(os.environ.get("RESULT_ZIP_WORKERS", 0)) or None
+    # Keep dep results of every file of a user, so that uploading a grown
+    # experiment again only processes the new files
+    DEP_INCREMENTAL = os.environ.get("DEP_INCREMENTAL", "1") == "1"
+    DEP_STATE_DIR = os.path.join(PROCESSED_DIR, "dep_state")
+    # Rows of files kept per user, those of the oldest uploads are dropped
+    DEP_STATE_MAX_ROWS = int(os.environ.get("DEP_STATE_MAX_ROWS", 100000))
+    # How trans/recal process files: "serial", "thread" or "process" pool
+    TRANSFORM_EXECUTOR = os.environ.get("TRANSFORM_EXECUTOR", "serial")
+    TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS", 0)) or None
+    TRANSFORM_CHUNKSIZE = int(os.environ.get("TRANSFORM_CHUNKSIZE", 1))
+    # Background job queue
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+    JOB_USER_CONCURRENCY = int(os.environ.get("JOB_USER_CONCURRENCY", 1))
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+    JOB_RETRY_DELAY = 10.0  # seconds, multiplied by the attempt number
+    JOB_POLL_INTERVAL = 1.0  # seconds
+    JOB_HEARTBEAT_INTERVAL = 60.0  # seconds
+    # Running jobs without a heartbeat for so long are stale
+    JOB_STALE_TIMEOUT = 600.0  # seconds
+    # Run the job workers when the app is loaded (not for manage.py)
+    JOB_QUEUE_AUTOSTART = os.environ.get("JOB_QUEUE_AUTOSTART", "1") == "1"
+    # Telegram user ids allowed to use admin commands, comma-separated
+    ADMIN_IDS = [
+        int(user_id)
+        for user_id in os.environ.get("ADMIN_IDS", "").split(",")
+        if user_id.strip()
+    ]
+    # cProfile stats of jobs marked by admins and of a share of other jobs
+    PROFILES_DIR = os.path.join(PROCESSED_DIR, "profiles")
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
 
 
 class ProductionConfig(Config):
     DEBUG = False
     THREADED = True
+    # Not "process": pools forked from the threaded server and job workers
+    # can inherit locks held by other threads and deadlock
+    TRANSFORM_EXECUTOR = os.environ.get("TRANSFORM_EXECUTOR", "thread")
 
 
 class DevelopmentConfig(Config):
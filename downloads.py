@@ -0,0 +1,188 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Optional
+
+import requests
+
+logger = logging.getLogger("IBCP-BOT")
+
+CHUNK_SIZE = 256 * 1024
+
+
+class DownloadError(IOError):
+    """The file could not be downloaded completely"""
+
+
+class TelegramFileCache(object):
+    """Thread-safe cache of getFile results by file_id
+
+    Download links returned by getFile are valid for at least an hour, so
+    File objects are reused for `ttl` seconds. The `max_entries` most
+    recently used ids are kept.
+    """
+
+    def __init__(self, ttl: float = 3000.0, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # type: OrderedDict
+        self.hits = 0
+        self.misses = 0
+
+    def get_file(self, bot, file_id: str):
+        """telegram.File of the file_id, getFile is called on a miss only"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._files.get(file_id)
+            if cached is not None and cached[0] > now:
+                self._files.move_to_end(file_id)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        file = bot.getFile(file_id)
+        with self._lock:
+            self._files[file_id] = (now + self.ttl, file)
+            self._files.move_to_end(file_id)
+            while len(self._files) > self.max_entries:
+                self._files.popitem(last=False)
+        return file
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._files),
+            }
+
+
+def file_url(file) -> str:
+    """Download URL of a telegram.File"""
+    if file.file_path.startswith(("http://", "https://")):
+        return file.file_path
+    return "%s/%s" % (file.bot.base_file_url, file.file_path)
+
+
+def download_to_path(
+    url: str,
+    path: str,
+    expected_size: Optional[int] = None,
+    retries: int = 3,
+    timeout: float = 30.0,
+) -> str:
+    """Download a file in chunks with resume and return its SHA-256
+
+    The content goes to `<path>.part` first. If a connection breaks, the
+    download continues from the already received bytes (HTTP Range), both
+    in the following retries and in later calls. The part file is renamed
+    to `path` only once it is complete, and its SHA-256 is written next to
+    it to `<path>.sha256`, so complete downloads are never fetched again.
+    """
+    checksum = read_checksum(path, expected_size)
+    if checksum is not None:
+        logger.debug("Reusing downloaded file %s" % path)
+        return checksum
+
+    part = path + ".part"
+    for attempt in range(1, retries + 1):
+        try:
+            checksum = _fetch(url, part, expected_size, timeout)
+            break
+        except (requests.RequestException, DownloadError) as e:
+            logger.warning(
+                "Download attempt %s of %s failed: %s" % (attempt, url, e)
+            )
+            if attempt == retries:
+                raise DownloadError(e)
+
+    os.replace(part, path)
+    write_checksum(path, checksum)
+    return checksum
+
+
+def download_to_buffer(
+    url: str,
+    out: BinaryIO,
+    expected_size: Optional[int] = None,
+    timeout: float = 30.0,
+) -> str:
+    """Download a file in chunks to a binary buffer and return its SHA-256"""
+    digest = hashlib.sha256()
+    size = 0
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            out.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+    _check_size(size, expected_size)
+    return digest.hexdigest()
+
+
+def _fetch(
+    url: str, part: str, expected_size: Optional[int], timeout: float
+) -> str:
+    # Hash what has been received already and ask only for the rest
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part):
+        with open(part, "rb") as fp:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                offset += len(chunk)
+    if expected_size is not None and offset > expected_size:
+        os.remove(part)
+        digest, offset = hashlib.sha256(), 0
+
+    headers = {"Range": "bytes=%s-" % offset} if offset else {}
+    with requests.get(
+        url, headers=headers, stream=True, timeout=timeout
+    ) as response:
+        if offset and response.status_code == 416:
+            # Nothing left to download
+            pass
+        else:
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # The server ignored the range, start from scratch
+                digest, offset = hashlib.sha256(), 0
+            with open(part, "ab" if offset else "wb") as fp:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    fp.write(chunk)
+                    digest.update(chunk)
+                    offset += len(chunk)
+    _check_size(offset, expected_size)
+    return digest.hexdigest()
+
+
+def _check_size(size: int, expected_size: Optional[int]) -> None:
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(
+            "Downloaded %s bytes instead of %s" % (size, expected_size)
+        )
+
+
+def read_checksum(
+    path: str, expected_size: Optional[int] = None
+) -> Optional[str]:
+    """Checksum of a complete earlier download of `path`, if any"""
+    try:
+        with open(path + ".sha256", "r") as fp:
+            checksum = fp.read().strip()
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    if expected_size is not None and size != expected_size:
+        return None
+    return checksum or None
+
+
+def write_checksum(path: str, checksum: str) -> None:
+    """Mark `path` as a complete download of the content, see read_checksum"""
+    with open(path + ".sha256", "w") as fp:
+        fp.write(checksum)
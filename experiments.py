@@ -0,0 +1,82 @@
+import os
+import uuid
+import pickle
+import logging
+import threading
+from typing import Dict, Optional
+
+import pandas as pd
+
+logger = logging.getLogger("IBCP-BOT")
+
+_locks = {}  # type: Dict[str, threading.RLock]
+_locks_lock = threading.Lock()
+
+
+class ExperimentState(object):
+    """Computed rows of the files of a user's experiments kept between jobs
+
+    Rows are indexed by the path of the file relative to the experiments
+    root and have a `hash` column with the SHA-256 of the file content, so
+    only new or changed files have to be processed again. The state is
+    dropped when its `version` (e.g. a fingerprint of the ratio files and
+    of the computation settings) differs from the current one. At most
+    `max_rows` rows are kept, the least recently updated ones are dropped.
+    """
+
+    def __init__(
+        self, path: str, version: str, max_rows: Optional[int] = None
+    ):
+        self.path = path
+        self.version = version
+        self.max_rows = max_rows
+        with _locks_lock:
+            self._lock = _locks.setdefault(path, threading.RLock())
+
+    def load(self) -> pd.DataFrame:
+        """Rows of the state, empty if there are none or they are stale"""
+        with self._lock:
+            try:
+                with open(self.path, "rb") as fp:
+                    state = pickle.load(fp)
+            except FileNotFoundError:
+                return pd.DataFrame()
+            except Exception as e:
+                logger.warning(
+                    "Broken experiment state %s: %s" % (self.path, e)
+                )
+                return pd.DataFrame()
+        if state.get("version") != self.version:
+            logger.debug("Dropping stale experiment state %s" % self.path)
+            return pd.DataFrame()
+        return state["rows"]
+
+    def save(self, rows: pd.DataFrame) -> None:
+        """Replace rows of the state"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = "%s.%s.tmp" % (self.path, uuid.uuid4().hex)
+        with open(tmp, "wb") as fp:
+            pickle.dump(
+                {"version": self.version, "rows": rows},
+                fp,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        with self._lock:
+            os.replace(tmp, self.path)
+
+    def update(self, rows: pd.DataFrame) -> pd.DataFrame:
+        """Add or replace rows by their index, returns all rows kept
+
+        Updated rows are moved to the end, the oldest rows are dropped
+        first.
+        """
+        with self._lock:
+            known = self.load()
+            if not known.empty:
+                rows = pd.concat(
+                    [known[~known.index.isin(rows.index)], rows], sort=False
+                )
+            if self.max_rows is not None and len(rows) > self.max_rows:
+                rows = rows.iloc[len(rows) - self.max_rows :]
+            self.save(rows)
+        return rows
@@ -0,0 +1,502 @@
+import os
+import time
+import random
+import cProfile
+import logging
+import datetime
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Jobs
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+logger = logging.getLogger("IBCP-BOT")
+
+
+class NonRetryableJobError(Exception):
+    """Raised by job handlers when retrying the job makes no sense"""
+
+
+class JobQueue(object):
+    """Job queue stored in the app database and run by a pool of threads
+
+    Workers are run by `start`, which the app calls on startup. A job is
+    claimed with a single conditional UPDATE, so several workers (or
+    processes sharing the database) never run the same job twice and
+    never run more than `per_user_limit` jobs of one user at once (see
+    `_claim`). Failed jobs are retried `max_attempts` times with a linear
+    back-off. If the handler returns a string, it is stored as the job
+    result path.
+
+    Running jobs get a heartbeat every `heartbeat_interval` seconds. Jobs
+    without one for `stale_timeout` (e.g. left by a crashed process) are
+    requeued, or failed once out of attempts, by the workers every
+    `stale_check_interval` seconds.
+
+    Jobs marked with `profile` and a `profile_sample_rate` share of the
+    others are run under cProfile, the stats are written to `profile_dir`
+    and their path is stored with the job (see `mark_for_profiling`).
+    """
+
+    def __init__(
+        self,
+        app,
+        handler: Callable[[Jobs], Optional[str]],
+        on_failure: Optional[Callable[[Jobs, Exception], None]] = None,
+        workers: int = 2,
+        per_user_limit: int = 1,
+        max_attempts: int = 3,
+        retry_delay: float = 10.0,
+        poll_interval: float = 1.0,
+        stale_timeout: float = 600.0,
+        stale_check_interval: float = 60.0,
+        heartbeat_interval: float = 60.0,
+        profile_dir: Optional[str] = None,
+        profile_sample_rate: float = 0.0,
+    ):
+        self.app = app
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.stale_check_interval = stale_check_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._next_stale_check = 0.0
+        self._stale_lock = threading.Lock()
+        self.profile_dir = profile_dir
+        self.profile_sample_rate = profile_sample_rate
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._counts = (0.0, None)  # type: Tuple[float, Optional[Dict]]
+        self._counts_lock = threading.Lock()
+        # Claims of the workers are serialized, see _claim
+        self._claim_lock = threading.Lock()
+        # Ids of the jobs run by this process, see _beat
+        self._running = set()  # type: Set[int]
+        self._running_lock = threading.Lock()
+        # Only one profiler can be active in the process at a time
+        self._profile_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app, handler, on_failure=None) -> "JobQueue":
+        return cls(
+            app,
+            handler,
+            on_failure=on_failure,
+            workers=app.config["JOB_WORKERS"],
+            per_user_limit=app.config["JOB_USER_CONCURRENCY"],
+            max_attempts=app.config["JOB_MAX_ATTEMPTS"],
+            retry_delay=app.config["JOB_RETRY_DELAY"],
+            poll_interval=app.config["JOB_POLL_INTERVAL"],
+            stale_timeout=app.config["JOB_STALE_TIMEOUT"],
+            heartbeat_interval=app.config["JOB_HEARTBEAT_INTERVAL"],
+            profile_dir=app.config["PROFILES_DIR"],
+            profile_sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+        )
+
+    # ===== PRODUCER =====
+    def enqueue(
+        self, userfile_id: int, action: str, user_id: int, chat_id: int
+    ) -> Tuple[Jobs, bool]:
+        """Put a job to the queue unless it is already known
+
+        There is a single job per (userfile_id, action) pair, guarded by a
+        unique constraint, so concurrent calls from any thread or process
+        end up with the same job. Returns the job and whether it was
+        (re)queued by this call. Queued, running and done jobs are
+        returned as is: the caller can attach to them or reuse their
+        result. Failed jobs are requeued.
+        """
+        with self.app.app_context():
+            try:
+                job = Jobs(
+                    userfile_id=userfile_id,
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    action=action,
+                    state="queued",
+                    attempts=0,
+                    max_attempts=self.max_attempts,
+                )
+                db.session.add(job)
+                db.session.commit()
+                db.session.refresh(job)
+                created = True
+            except IntegrityError:
+                db.session.rollback()
+                job = (
+                    db.session.query(Jobs)
+                    .filter_by(userfile_id=userfile_id, action=action)
+                    .one()
+                )
+                created = False
+            db.session.expunge(job)
+
+        if created:
+            logger.debug("Enqueued job %s" % job)
+            self._wakeup.set()
+        elif job.state == "failed":
+            created = self.requeue(job)
+        else:
+            logger.debug("Job is already known: %s" % job)
+        return job, created
+
+    def requeue(self, job: Jobs, profile: bool = False) -> bool:
+        """Run a done or failed job once again, profiled if `profile`
+
+        Returns False if the job has been requeued by someone else already.
+        """
+        with self.app.app_context():
+            requeued = (
+                db.session.query(Jobs)
+                .filter(Jobs.id == job.id, Jobs.state.in_(("done", "failed")))
+                .update(
+                    {
+                        Jobs.state: "queued",
+                        Jobs.attempts: 0,
+                        Jobs.error: None,
+                        Jobs.result_path: None,
+                        Jobs.profile: profile,
+                        Jobs.available_at: datetime.datetime.utcnow(),
+                    },
+                    synchronize_session=False,
+                )
+            )
+            db.session.commit()
+        if requeued:
+            job.state = "queued"
+            job.profile = profile
+            logger.debug("Requeued job %s" % job)
+            self._wakeup.set()
+        return bool(requeued)
+
+    def mark_for_profiling(self, job_id: int) -> Optional[Jobs]:
+        """Rerun a done or failed job under the profiler
+
+        The rerun sends nothing to the user and is not retried.
+        Returns the job or None if there is no such job. Queued and running
+        jobs are not marked, their `profile` is False.
+        """
+        with self.app.app_context():
+            job = db.session.query(Jobs).get(job_id)
+            if job is None:
+                return None
+            db.session.expunge(job)
+        self.requeue(job, profile=True)
+        return job
+
+    def depth(self) -> int:
+        """Number of jobs waiting to be run"""
+        with self.app.app_context():
+            return (
+                db.session.query(func.count(Jobs.id))
+                .filter(Jobs.state == "queued")
+                .scalar()
+            )
+
+    def state_counts(self, max_age: float = 0.0) -> Dict[str, int]:
+        """Number of jobs in every state
+
+        Counts computed less than `max_age` seconds ago are reused, so that
+        frequent scrapes of the metrics do not scan the jobs table.
+        """
+        with self._counts_lock:
+            counted_at, counts = self._counts
+            if counts is not None and time.monotonic() - counted_at < max_age:
+                return dict(counts)
+        with self.app.app_context():
+            rows = (
+                db.session.query(Jobs.state, func.count(Jobs.id))
+                .group_by(Jobs.state)
+                .all()
+            )
+        counts = dict.fromkeys(JOB_STATES, 0)
+        counts.update(rows)
+        with self._counts_lock:
+            self._counts = (time.monotonic(), counts)
+        return dict(counts)
+
+    # ===== WORKERS =====
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name="job-worker-%s" % i, daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(
+                target=self._beat, name="job-heartbeat", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            self._stop.set()
+            self._wakeup.set()
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            self._check_stale()
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error("Could not claim a job: %s" % e)
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _beat(self) -> None:
+        """Update the heartbeat of the jobs run by this process"""
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._running_lock:
+                job_ids = list(self._running)
+            if not job_ids:
+                continue
+            try:
+                with self.app.app_context():
+                    db.session.query(Jobs).filter(
+                        Jobs.id.in_(job_ids), Jobs.state == "running"
+                    ).update(
+                        {Jobs.heartbeat_at: datetime.datetime.utcnow()},
+                        synchronize_session=False,
+                    )
+                    db.session.commit()
+            except Exception as e:
+                logger.error("Could not update job heartbeats: %s" % e)
+
+    def _claim(self) -> Optional[Jobs]:
+        """Switch the oldest runnable job to the running state
+
+        The conditional UPDATE makes sure the job is claimed only once.
+        The per-user limit it checks is only reliable if concurrent claims
+        of a user's jobs are serialized: workers of the process take a
+        lock, and the user's jobs are locked with SELECT ... FOR UPDATE
+        (e.g. on Postgres, where the count could otherwise be stale under
+        READ COMMITTED). SQLite serializes all writes by itself.
+        """
+        with self._claim_lock:
+            return self._claim_locked()
+
+    def _claim_locked(self) -> Optional[Jobs]:
+        now = datetime.datetime.utcnow()
+        with self.app.app_context():
+            candidates = (
+                db.session.query(Jobs.id, Jobs.user_id)
+                .filter(Jobs.state == "queued", Jobs.available_at <= now)
+                .order_by(Jobs.id)
+                .limit(self.workers * 4)
+                .all()
+            )
+            running = Jobs.__table__.alias("running")
+            for job_id, user_id in candidates:
+                # Row locks of other processes claiming for the user
+                db.session.query(Jobs.id).filter(
+                    Jobs.user_id == user_id
+                ).order_by(Jobs.id).with_for_update().all()
+                user_running = (
+                    db.session.query(func.count(running.c.id))
+                    .filter(
+                        running.c.user_id == user_id,
+                        running.c.state == "running",
+                    )
+                    .as_scalar()
+                )
+                claimed = (
+                    db.session.query(Jobs)
+                    .filter(
+                        Jobs.id == job_id,
+                        Jobs.state == "queued",
+                        user_running < self.per_user_limit,
+                    )
+                    .update(
+                        {
+                            Jobs.state: "running",
+                            Jobs.attempts: Jobs.attempts + 1,
+                            Jobs.started_at: now,
+                            Jobs.heartbeat_at: now,
+                        },
+                        synchronize_session=False,
+                    )
+                )
+                db.session.commit()
+                if claimed:
+                    job = db.session.query(Jobs).get(job_id)
+                    db.session.expunge(job)
+                    return job
+        return None
+
+    def _run(self, job: Jobs) -> None:
+        logger.debug("Running job %s" % job)
+        with self._running_lock:
+            self._running.add(job.id)
+        try:
+            result = self._call_handler(job)
+        except Exception as e:
+            logger.error("Job %s failed: %s" % (job.id, e))
+            # Profiled reruns are silent, a failure is in the profile
+            retry = (
+                job.attempts < job.max_attempts
+                and not job.profile
+                and not isinstance(e, NonRetryableJobError)
+            )
+            self._finish(job, "queued" if retry else "failed", e)
+            if not retry and self.on_failure is not None:
+                try:
+                    self.on_failure(job, e)
+                except Exception as callback_error:
+                    logger.error(callback_error)
+        else:
+            self._finish(
+                job,
+                "done",
+                result_path=result if isinstance(result, str) else None,
+            )
+        finally:
+            with self._running_lock:
+                self._running.discard(job.id)
+
+    def _call_handler(self, job: Jobs) -> Optional[str]:
+        """Run the handler, under the profiler if the job is to be profiled"""
+        if self.profile_dir is None:
+            return self.handler(job)
+        if job.profile:
+            # Wait for other profiled jobs, the profile was asked for
+            locked = self._profile_lock.acquire()
+        elif random.random() < self.profile_sample_rate:
+            # Sampled jobs are not worth waiting for
+            locked = self._profile_lock.acquire(blocking=False)
+        else:
+            locked = False
+        if not locked:
+            return self.handler(job)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.handler, job)
+        finally:
+            self._profile_lock.release()
+            try:
+                self._save_profile(job, profiler)
+            except Exception as e:
+                logger.error(
+                    "Could not save profile of job %s: %s" % (job.id, e)
+                )
+
+    def _save_profile(self, job: Jobs, profiler: cProfile.Profile) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile_path = os.path.join(
+            self.profile_dir, "job_%s_%s.prof" % (job.id, job.attempts)
+        )
+        profiler.dump_stats(profile_path)
+        with self.app.app_context():
+            db.session.query(Jobs).filter(Jobs.id == job.id).update(
+                {Jobs.profile: False, Jobs.profile_path: profile_path},
+                synchronize_session=False,
+            )
+            db.session.commit()
+        job.profile_path = profile_path
+        logger.info(
+            "Profile of job %s is written to %s" % (job.id, profile_path)
+        )
+
+    def _finish(
+        self,
+        job: Jobs,
+        state: str,
+        error: Optional[Exception] = None,
+        result_path: Optional[str] = None,
+    ) -> None:
+        now = datetime.datetime.utcnow()
+        values = {Jobs.state: state, Jobs.result_path: result_path}
+        if error is not None:
+            values[Jobs.error] = str(error)
+        if state == "queued":
+            values[Jobs.available_at] = now + datetime.timedelta(
+                seconds=self.retry_delay * job.attempts
+            )
+        else:
+            values[Jobs.finished_at] = now
+        with self.app.app_context():
+            db.session.query(Jobs).filter(Jobs.id == job.id).update(
+                values, synchronize_session=False
+            )
+            db.session.commit()
+        job.state = state
+        job.result_path = result_path
+
+    def _check_stale(self) -> None:
+        """Requeue stale jobs if no worker did it for a while"""
+        with self._stale_lock:
+            now = time.monotonic()
+            if now < self._next_stale_check:
+                return
+            self._next_stale_check = now + self.stale_check_interval
+        try:
+            self._requeue_stale()
+        except Exception as e:
+            logger.error("Could not requeue stale jobs: %s" % e)
+
+    def _requeue_stale(self) -> None:
+        """Requeue jobs left running (e.g. by a crash) or fail them
+
+        Jobs out of attempts are failed, so that a job which crashes the
+        process is not run forever.
+        """
+        beat_before = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.stale_timeout
+        )
+        is_stale = (
+            Jobs.state == "running",
+            func.coalesce(Jobs.heartbeat_at, Jobs.started_at) < beat_before,
+        )
+        with self.app.app_context():
+            stale = db.session.query(Jobs).filter(*is_stale).all()
+            for job in stale:
+                db.session.expunge(job)
+        error = NonRetryableJobError("The job stopped without finishing")
+        for job in stale:
+            failed = job.attempts >= job.max_attempts
+            values = {Jobs.state: "failed" if failed else "queued"}
+            if failed:
+                values[Jobs.error] = str(error)
+                values[Jobs.finished_at] = datetime.datetime.utcnow()
+            with self.app.app_context():
+                # Unless another process has handled the job meanwhile
+                updated = (
+                    db.session.query(Jobs)
+                    .filter(Jobs.id == job.id, *is_stale)
+                    .update(values, synchronize_session=False)
+                )
+                db.session.commit()
+            if not updated:
+                continue
+            logger.warning(
+                "%s stale job %s" % ("Failed" if failed else "Requeued", job)
+            )
+            if failed and self.on_failure is not None:
+                job.state = "failed"
+                try:
+                    self.on_failure(job, error)
+                except Exception as callback_error:
+                    logger.error(callback_error)
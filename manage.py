@@ -3,7 +3,10 @@ from dotenv import load_dotenv
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app, db
+# Migrations run without the job workers
+os.environ.setdefault("JOB_QUEUE_AUTOSTART", "0")
+
+from app import app, db  # noqa: E402
 
 load_dotenv(".env")
 
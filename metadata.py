@@ -0,0 +1,69 @@
+import os
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+def split_paths(paths: Sequence[str], root: str) -> pd.DataFrame:
+    """Categorical path parts of spectrum files under `root`
+
+    Columns are `filename` (base name), `folder` (directory relative to
+    `root`), `experiment` (first folder) and `parent` (last folder). Every
+    path is split only once, the rest is computed for unique directories,
+    so the cost of a column does not grow with the number of files in a
+    folder.
+    """
+    dirs, names = [], []
+    for path in paths:
+        dirname, _, name = path.rpartition(os.path.sep)
+        dirs.append(dirname)
+        names.append(name)
+    dirs = pd.Categorical(dirs)
+    folders = [d[len(root) :].lstrip(os.path.sep) for d in dirs.categories]
+    return pd.DataFrame(
+        {
+            "filename": pd.Categorical(names),
+            "folder": _recode(dirs, folders),
+            "experiment": _recode(
+                dirs, [f.split(os.path.sep)[0] for f in folders]
+            ),
+            "parent": _recode(
+                dirs, [d.rpartition(os.path.sep)[2] for d in dirs.categories]
+            ),
+        }
+    )
+
+
+def extract_fields(
+    values: pd.Series,
+    pattern: str,
+    converters: Optional[Dict[str, Callable]] = None,
+) -> pd.DataFrame:
+    """`Series.str.extract` run once per unique value
+
+    Columns are named by the groups of `pattern`, rows which do not match
+    are NaN. Columns are categorical except for those in `converters`,
+    which map columns to functions applied to every unique value of them
+    (e.g. to parse numbers).
+    """
+    values = pd.Categorical(values)
+    fields = pd.Series(values.categories).str.extract(pattern, expand=True)
+    columns = {}
+    for column in fields:
+        field = _recode(values, fields[column])
+        convert = (converters or {}).get(column)
+        if convert is not None:
+            # Missing values (code -1) pick the appended NaN
+            converted = [convert(value) for value in field.categories]
+            field = pd.Series(converted + [np.nan]).values[field.codes]
+        columns[column] = field
+    return pd.DataFrame(columns)
+
+
+def _recode(values: pd.Categorical, mapped: Sequence) -> pd.Categorical:
+    """Categorical of `mapped[category]` for every value of `values`"""
+    mapped = pd.Categorical(mapped)
+    # Missing values (code -1) pick the appended -1
+    codes = np.append(mapped.codes, -1)[values.codes]
+    return pd.Categorical.from_codes(codes, mapped.categories)
@@ -0,0 +1,196 @@
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+logger = logging.getLogger("IBCP-BOT")
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+STAGE_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+Samples = Union[float, Iterable[Tuple[Dict[str, str], float]]]
+
+
+class JobMetrics(object):
+    """Thread-safe metrics of jobs in Prometheus text format
+
+    Job metrics are taken from finished traces (see tracing.Trace.finish),
+    other values (queue depth, cache stats) are read on every scrape from
+    the registered collectors. Rendering only formats counters kept in
+    memory, so it is cheap to scrape often.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._jobs = {}  # type: Dict[Labels, float]
+        self._files = {}  # type: Dict[Labels, float]
+        self._bytes = {}  # type: Dict[Labels, float]
+        # stage: [count per bucket (the last one is +Inf), sum]
+        self._stages = {}  # type: Dict[str, List]
+        self._collectors = []  # type: List[Tuple[str, str, str, Callable]]
+
+    def observe_trace(self, trace: Dict) -> None:
+        """Count a finished job trace"""
+        action = trace["action"]
+        with self._lock:
+            _inc(self._jobs, (("action", action), ("status", trace["status"])))
+            for stage in trace["stages"]:
+                self._observe_stage(stage["stage"], stage["seconds"])
+                if stage["stage"] == "download" and stage.get("bytes"):
+                    _inc(self._bytes, (("direction", "down"),), stage["bytes"])
+                elif stage["stage"] == "send_document" and stage.get("bytes"):
+                    _inc(self._bytes, (("direction", "up"),), stage["bytes"])
+                elif stage["stage"] == "action" and "files" in stage:
+                    failed = stage.get("failed", 0)
+                    _inc(
+                        self._files,
+                        (("action", action), ("status", "ok")),
+                        stage["files"] - failed,
+                    )
+                    _inc(
+                        self._files,
+                        (("action", action), ("status", "failed")),
+                        failed,
+                    )
+            self._observe_stage("job", trace["seconds"])
+
+    def _observe_stage(self, stage: str, seconds: float) -> None:
+        if stage not in self._stages:
+            self._stages[stage] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts, _ = self._stages[stage]
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self._stages[stage][1] += seconds
+
+    def register(
+        self, name: str, kind: str, help: str, collect: Callable[[], Samples]
+    ) -> None:
+        """Add a metric read on every scrape
+
+        `collect` returns a value or (labels, value) pairs. Errors of
+        collectors are logged and the metric is skipped.
+        """
+        self._collectors.append((name, kind, help, collect))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            _family(
+                lines,
+                "ibcp_jobs_total",
+                "counter",
+                "Finished jobs by action and status",
+                self._jobs,
+            )
+            _family(
+                lines,
+                "ibcp_files_total",
+                "counter",
+                "Files processed by actions by status",
+                self._files,
+            )
+            _family(
+                lines,
+                "ibcp_bytes_total",
+                "counter",
+                "Bytes downloaded from and uploaded to Telegram",
+                self._bytes,
+            )
+            lines.append(
+                "# HELP ibcp_stage_duration_seconds Duration of job stages"
+            )
+            lines.append("# TYPE ibcp_stage_duration_seconds histogram")
+            for stage, (counts, total) in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(
+                        'ibcp_stage_duration_seconds_bucket{stage="%s",le="%s"}'
+                        " %s" % (_escape(stage), bound, cumulative)
+                    )
+                lines.append(
+                    'ibcp_stage_duration_seconds_sum{stage="%s"} %s'
+                    % (_escape(stage), total)
+                )
+                lines.append(
+                    'ibcp_stage_duration_seconds_count{stage="%s"} %s'
+                    % (_escape(stage), cumulative)
+                )
+
+        for name, kind, help, collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.error("Could not collect metric %s: %s" % (name, e))
+                continue
+            if isinstance(samples, (int, float)):
+                samples = [({}, samples)]
+            _family(
+                lines,
+                name,
+                kind,
+                help,
+                {
+                    tuple(sorted(labels.items())): value
+                    for labels, value in samples
+                },
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _inc(counter: Dict[Labels, float], labels: Labels, value=1) -> None:
+    counter[labels] = counter.get(labels, 0) + value
+
+
+def _family(
+    lines: List[str],
+    name: str,
+    kind: str,
+    help: str,
+    samples: Dict[Labels, float],
+) -> None:
+    lines.append("# HELP %s %s" % (name, help))
+    lines.append("# TYPE %s %s" % (name, kind))
+    for labels, value in sorted(samples.items()):
+        if labels:
+            lines.append(
+                "%s{%s} %s"
+                % (
+                    name,
+                    ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels),
+                    value,
+                )
+            )
+        else:
+            lines.append("%s %s" % (name, value))
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+# Process-wide metrics of all jobs
+job_metrics = JobMetrics()
@@ -0,0 +1,36 @@
+"""widen jobs action for several actions of a job
+
+Revision ID: 5b7e2c9d4f10
+Revises: 8f2d6e0b9a13
+Create Date: 2026-10-17 21:08:41.203117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5b7e2c9d4f10"
+down_revision = "8f2d6e0b9a13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.alter_column(
+            "action",
+            existing_type=sa.String(length=16),
+            type_=sa.String(length=32),
+            existing_nullable=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.alter_column(
+            "action",
+            existing_type=sa.String(length=32),
+            type_=sa.String(length=16),
+            existing_nullable=False,
+        )
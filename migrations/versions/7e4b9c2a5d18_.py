@@ -0,0 +1,28 @@
+"""content hash of userfiles
+
+Revision ID: 7e4b9c2a5d18
+Revises: d3f5a7c9e1b2
+Create Date: 2026-10-18 09:26:51.204117
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "7e4b9c2a5d18"
+down_revision = "d3f5a7c9e1b2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("userfiles") as batch_op:
+        batch_op.add_column(
+            sa.Column("content_sha256", sa.String(length=64), nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("userfiles") as batch_op:
+        batch_op.drop_column("content_sha256")
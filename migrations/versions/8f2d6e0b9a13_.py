@@ -0,0 +1,37 @@
+"""deduplicate jobs by user file and action
+
+Revision ID: 8f2d6e0b9a13
+Revises: 3c9a1f6d2b47
+Create Date: 2026-10-17 13:02:17.558930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8f2d6e0b9a13"
+down_revision = "3c9a1f6d2b47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep only the latest job of every (userfile_id, action) pair
+    op.execute(
+        "DELETE FROM jobs WHERE id NOT IN "
+        "(SELECT MAX(id) FROM jobs GROUP BY userfile_id, action)"
+    )
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.add_column(
+            sa.Column("result_path", sa.String(length=255), nullable=True)
+        )
+        batch_op.create_unique_constraint(
+            "uq_jobs_userfile_action", ["userfile_id", "action"]
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.drop_constraint("uq_jobs_userfile_action", type_="unique")
+        batch_op.drop_column("result_path")
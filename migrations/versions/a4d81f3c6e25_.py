@@ -0,0 +1,37 @@
+"""profiling of jobs
+
+Revision ID: a4d81f3c6e25
+Revises: 5b7e2c9d4f10
+Create Date: 2026-10-17 23:41:09.772384
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "a4d81f3c6e25"
+down_revision = "5b7e2c9d4f10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                "profile",
+                sa.Boolean(),
+                nullable=False,
+                server_default=sa.false(),
+            )
+        )
+        batch_op.add_column(
+            sa.Column("profile_path", sa.String(length=255), nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.drop_column("profile_path")
+        batch_op.drop_column("profile")
@@ -0,0 +1,28 @@
+"""heartbeat of jobs
+
+Revision ID: b6c1e8f0a934
+Revises: 7e4b9c2a5d18
+Create Date: 2026-10-18 11:04:27.618352
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b6c1e8f0a934"
+down_revision = "7e4b9c2a5d18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.add_column(
+            sa.Column("heartbeat_at", sa.DateTime(), nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("jobs") as batch_op:
+        batch_op.drop_column("heartbeat_at")
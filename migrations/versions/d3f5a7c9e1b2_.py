@@ -0,0 +1,33 @@
+"""index userfiles lookups
+
+Revision ID: d3f5a7c9e1b2
+Revises: a4d81f3c6e25
+Create Date: 2026-10-18 01:12:37.415902
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d3f5a7c9e1b2"
+down_revision = "a4d81f3c6e25"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f("ix_userfiles_user_id"), "userfiles", ["user_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_userfiles_chat_id"), "userfiles", ["chat_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_userfiles_file_id"), "userfiles", ["file_id"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_userfiles_file_id"), table_name="userfiles")
+    op.drop_index(op.f("ix_userfiles_chat_id"), table_name="userfiles")
+    op.drop_index(op.f("ix_userfiles_user_id"), table_name="userfiles")
@@ -1,4 +1,5 @@
 import json
+import datetime
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
@@ -8,11 +9,13 @@ class UserFiles(db.Model):  # type: ignore
     __tablename__ = "userfiles"
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, nullable=False)
-    chat_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    chat_id = db.Column(db.Integer, nullable=False, index=True)
     message_id = db.Column(db.Integer, nullable=False)
-    file_id = db.Column(db.String(64), nullable=False)
+    file_id = db.Column(db.String(64), nullable=False, index=True)
     file_name = db.Column(db.String(64), nullable=False)
+    # SHA-256 of the downloaded content, see utils.download_file
+    content_sha256 = db.Column(db.String(64), nullable=True)
 
     def __str__(self):
         return json.dumps(
@@ -23,6 +26,65 @@ class UserFiles(db.Model):  # type: ignore
                 "message_id": self.message_id,
                 "file_id": self.file_id,
                 "file_name": self.file_name,
+                "content_sha256": self.content_sha256,
+            }
+        )
+
+    def __repr__(self):
+        return str(self)
+
+
+class Jobs(db.Model):  # type: ignore
+    __tablename__ = "jobs"
+    # A user file is processed by an action only once, see jobs.JobQueue
+    __table_args__ = (
+        db.UniqueConstraint(
+            "userfile_id", "action", name="uq_jobs_userfile_action"
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    userfile_id = db.Column(
+        db.Integer, db.ForeignKey("userfiles.id"), nullable=False
+    )
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    chat_id = db.Column(db.Integer, nullable=False)
+    # One action or several joined by "+", see bot.ACTIONS_SEPARATOR
+    action = db.Column(db.String(32), nullable=False)
+    # One of jobs.JOB_STATES
+    state = db.Column(db.String(16), nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    available_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    started_at = db.Column(db.DateTime, nullable=True)
+    # Updated while the job is run, see jobs.JobQueue._beat
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    result_path = db.Column(db.String(255), nullable=True)
+    # Silent rerun under the profiler, see jobs.JobQueue.mark_for_profiling
+    profile = db.Column(db.Boolean, nullable=False, default=False)
+    profile_path = db.Column(db.String(255), nullable=True)
+
+    def __str__(self):
+        return json.dumps(
+            {
+                "id": self.id,
+                "userfile_id": self.userfile_id,
+                "user_id": self.user_id,
+                "chat_id": self.chat_id,
+                "action": self.action,
+                "state": self.state,
+                "attempts": self.attempts,
+                "max_attempts": self.max_attempts,
+                "error": self.error,
+                "result_path": self.result_path,
+                "profile_path": self.profile_path,
             }
         )
 
@@ -0,0 +1,138 @@
+import warnings
+from typing import Dict, Iterable, NamedTuple, Tuple
+
+import numpy as np
+
+METRICS = ("max", "median", "area", "baseline_max", "baseline_area")
+
+# numpy>=2.0 renamed trapz to trapezoid
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+class Window(NamedTuple):
+    """Raman shift range, both ends included (like `Spectra[:, :, lo:hi]`)"""
+
+    lo: float
+    hi: float
+
+
+def window_slice(wl: np.ndarray, window: Tuple[float, float]) -> slice:
+    """Positions of `wl` values inside the window
+
+    `wl` must be sorted, so the result is a slice and the data of the
+    window can be taken as a view without copying.
+    """
+    wl = np.asarray(wl)
+    if wl.shape[0] > 1 and not (wl[1:] >= wl[:-1]).all():
+        raise ValueError("Raman shifts must be sorted in ascending order")
+    start = np.searchsorted(wl, window[0], side="left")
+    stop = np.searchsorted(wl, window[1], side="right")
+    return slice(int(start), int(stop))
+
+
+def window_metrics(
+    spc: np.ndarray,
+    wl: np.ndarray,
+    window: Tuple[float, float],
+    metrics: Iterable[str] = METRICS,
+) -> Dict[str, np.ndarray]:
+    """Compute metrics of every spectrum (row of `spc`) inside the window
+
+    - max, median: of the values in the window (NaNs are skipped)
+    - area: trapezoidal integral over Raman shift
+    - baseline_max, baseline_area: max and area of the values minus a
+      two-point linear baseline through the first and the last points of
+      the window. As with `approx_na(method="linear")`, the baseline is
+      interpolated by position, not by Raman shift.
+    """
+    metrics = tuple(metrics)
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError("Unknown metrics: %s" % ", ".join(sorted(unknown)))
+
+    positions = window_slice(wl, window)
+    values = np.asarray(spc)[:, positions]
+    x = np.asarray(wl)[positions]
+    n_points = values.shape[1]
+    if n_points == 0:
+        raise ValueError("No data in the window %s-%s" % tuple(window))
+
+    res = {}
+    with warnings.catch_warnings():
+        # All-NaN spectra give NaN metrics, that is expected
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if "max" in metrics:
+            res["max"] = np.nanmax(values, axis=1)
+        if "median" in metrics:
+            res["median"] = np.nanmedian(values, axis=1)
+        if "area" in metrics:
+            res["area"] = _trapezoid(values, x, axis=1)
+        if "baseline_max" in metrics or "baseline_area" in metrics:
+            first = values[:, :1]
+            slope = (values[:, -1:] - first) / max(n_points - 1, 1)
+            corrected = values - (first + slope * np.arange(n_points))
+            if "baseline_max" in metrics:
+                res["baseline_max"] = np.nanmax(corrected, axis=1)
+            if "baseline_area" in metrics:
+                res["baseline_area"] = _trapezoid(corrected, x, axis=1)
+    return res
+
+
+class AnalytePeak(NamedTuple):
+    """How the peak of an analyte is measured
+
+    The peak value is `peak_metric` of the `peak` window minus
+    `background_metric` of the `background` window. `aliases` are the
+    analyte names used in file names.
+    """
+
+    aliases: Tuple[str, ...]
+    peak: Window
+    background: Window
+    peak_metric: str = "max"
+    background_metric: str = "median"
+
+
+def compute_metrics(
+    spc: np.ndarray,
+    wl: np.ndarray,
+    requests: Iterable[Tuple[Tuple[float, float], str]],
+) -> Dict[Tuple[Tuple[float, float], str], np.ndarray]:
+    """Compute (window, metric) pairs reducing every window only once
+
+    Requests are grouped by window, so a window used by several analytes
+    or metrics is sliced and reduced in a single `window_metrics` call.
+    """
+    by_window: Dict[Tuple[float, float], set] = {}
+    for window, metric in requests:
+        by_window.setdefault(tuple(window), set()).add(metric)
+
+    res = {}
+    for window, metrics in by_window.items():
+        values = window_metrics(spc, wl, window, sorted(metrics))
+        for metric, value in values.items():
+            res[(window, metric)] = value
+    return res
+
+
+def analyte_peaks(
+    spc: np.ndarray, wl: np.ndarray, analytes: Dict[str, AnalytePeak]
+) -> Dict[str, np.ndarray]:
+    """Peak minus background values of every analyte"""
+    metrics = compute_metrics(
+        spc,
+        wl,
+        [
+            request
+            for analyte in analytes.values()
+            for request in (
+                (analyte.peak, analyte.peak_metric),
+                (analyte.background, analyte.background_metric),
+            )
+        ],
+    )
+    return {
+        name: metrics[(tuple(analyte.peak), analyte.peak_metric)]
+        - metrics[(tuple(analyte.background), analyte.background_metric)]
+        for name, analyte in analytes.items()
+    }
@@ -0,0 +1,134 @@
+import os
+import glob
+import hashlib
+import threading
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class RatioTable(NamedTuple):
+    """Ratio coefficients of a single c code
+
+    `coeffs` is indexed by pixel: `coeffs[pixel]` is the coefficient of the
+    pixel, or NaN if the ratio file has no value for it.
+    """
+
+    ccode: str
+    pixels: np.ndarray
+    coeffs: np.ndarray
+
+    def lookup(self, pixels: np.ndarray) -> np.ndarray:
+        """Get coefficients for an array of pixels (NaN for unknown pixels)"""
+        pixels = np.asarray(pixels, dtype=np.int64)
+        valid = (pixels >= 0) & (pixels < self.coeffs.shape[0])
+        res = np.full(pixels.shape, np.nan, dtype=self.coeffs.dtype)
+        res[valid] = self.coeffs[pixels[valid]]
+        return res
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {"Pixel": self.pixels, "Coeff": self.coeffs[self.pixels]}
+        )
+
+
+def read_ratio_file(filepath: str) -> RatioTable:
+    """Read a ratio file (`<pixel>;<coeff>` rows) to a RatioTable"""
+    df = pd.read_csv(
+        filepath,
+        header=None,
+        sep=";",
+        names=["Pixel", "Coeff"],
+        dtype={"Pixel": np.int64, "Coeff": np.float64},
+    )
+    pixels = df["Pixel"].values
+    if pixels.size and pixels.min() < 0:
+        raise ValueError("Negative pixel in the ratio file %s" % filepath)
+    coeffs = np.full(
+        pixels.max() + 1 if pixels.size else 0, np.nan, dtype=np.float64
+    )
+    coeffs[pixels] = df["Coeff"].values
+    ccode = os.path.basename(filepath).split(".")[0]
+    return RatioTable(
+        ccode=ccode, pixels=pixels.astype(np.uint16), coeffs=coeffs
+    )
+
+
+class RatioFilesCache(object):
+    """Thread-safe process-wide cache of ratio tables
+
+    Every table is read once and kept until the underlying file changes
+    (its mtime or size differ from the cached ones).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables: Dict[str, Tuple[Tuple[int, int], RatioTable]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ratio_files_dir: str, ccode: str) -> RatioTable:
+        filepath = os.path.abspath(
+            os.path.join(ratio_files_dir, f"{ccode.upper()}.txt")
+        )
+        stat = os.stat(filepath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._tables.get(filepath)
+            if cached is not None and cached[0] == signature:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        # Read outside of the lock: parallel misses on different files
+        # should not wait for each other
+        table = read_ratio_file(filepath)
+        with self._lock:
+            self._tables[filepath] = (signature, table)
+        return table
+
+    def ccodes(self, ratio_files_dir: str) -> List[str]:
+        """List c codes which have ratio files in the directory"""
+        return sorted(
+            os.path.basename(ratio_file).split(".")[0]
+            for ratio_file in glob.glob(
+                os.path.join(ratio_files_dir, "*.txt"), recursive=False
+            )
+        )
+
+    def version(self, ratio_files_dir: str) -> str:
+        """Fingerprint of all ratio files (changes when any file changes)"""
+        digest = hashlib.sha1()
+        for ratio_file in sorted(
+            glob.glob(os.path.join(ratio_files_dir, "*.txt"), recursive=False)
+        ):
+            stat = os.stat(ratio_file)
+            digest.update(
+                (
+                    "%s;%s;%s;"
+                    % (
+                        os.path.basename(ratio_file),
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                    )
+                ).encode("utf-8")
+            )
+        return digest.hexdigest()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._tables),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+ratio_cache = RatioFilesCache()
@@ -0,0 +1,226 @@
+import re
+import datetime
+from typing import BinaryIO, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+DATETIME_FORMAT = "yyyy-mm-dd hh:mm:ss"
+
+# Columnar formats of a batch of spectra, also used as file extensions
+SPECTRA_FORMATS = ("parquet", "feather", "npz")
+
+
+def write_excel_report(
+    output: Union[str, BinaryIO],
+    df: pd.DataFrame,
+    sheet_by: str,
+    columns: Sequence[str],
+    widths: Optional[Dict[str, Union[float, str]]] = None,
+    sheets: Optional[Sequence] = None,
+) -> None:
+    """Write `columns` of `df` to an Excel file, one sheet per `sheet_by`
+
+    Rows are grouped once and streamed to a constant-memory workbook
+    (xlsxwriter if installed, write-only openpyxl otherwise). `widths`
+    maps column names to widths; "auto" means the longest value in the
+    sheet + 2. Sheets are created for all `sheets` values (by default the
+    categories of a categorical `sheet_by` or its sorted unique values),
+    even if they have no rows.
+    """
+    widths = widths or {}
+    if sheets is None:
+        sheets = (
+            df[sheet_by].cat.categories
+            if hasattr(df[sheet_by], "cat")
+            else sorted(df[sheet_by].dropna().unique())
+        )
+    groups = df.groupby(sheet_by, sort=False, observed=True).indices
+    auto_widths = {
+        column: df[column].astype(str).str.len().groupby(df[sheet_by]).max()
+        for column, width in widths.items()
+        if width == "auto"
+    }
+
+    arrays = {column: np.asarray(df[column]) for column in columns}
+
+    writer = _XlsxWriter(output) if xlsxwriter else _OpenpyxlWriter(output)
+    used_names: set = set()
+    for sheet in sheets:
+        rows = groups.get(sheet, np.array([], dtype=np.int64))
+        sheet_widths = []
+        for column in columns:
+            width = widths.get(column)
+            if width == "auto":
+                width = auto_widths[column].get(sheet, 0)
+                width = 2 if pd.isna(width) else width + 2
+            sheet_widths.append(width)
+        writer.add_sheet(_sheet_name(str(sheet), used_names), sheet_widths)
+        writer.write_row(list(columns))
+        values = [_column_values(arrays[column][rows]) for column in columns]
+        for row in zip(*values):
+            writer.write_row(row)
+    writer.close()
+
+
+def check_spectra_format(fmt: str) -> None:
+    """Raise ValueError if spectra can't be written in the format"""
+    if fmt not in SPECTRA_FORMATS:
+        raise ValueError(
+            "Unknown output format: %s. Expected one of: %s"
+            % (fmt, ", ".join(SPECTRA_FORMATS))
+        )
+    if fmt != "npz" and pyarrow is None:
+        raise ValueError("%s output requires pyarrow" % fmt)
+
+
+def write_spectra_table(
+    output: Union[str, BinaryIO],
+    spc: pd.DataFrame,
+    data: pd.DataFrame,
+    fmt: str,
+) -> None:
+    """Write a batch of spectra with their metadata to a columnar file
+
+    `spc` has a spectrum per row and Raman shifts as columns, `data` has
+    metadata of the same rows. Parquet and Feather files (need pyarrow)
+    hold a single table: metadata columns followed by a column per Raman
+    shift named by its value. NPZ files hold the float32 `spc` matrix, the
+    `wl` axis and an array per metadata column.
+    """
+    check_spectra_format(fmt)
+    data = data.reset_index(drop=True)
+    if fmt == "npz":
+        # Text columns are stored as unicode arrays to load without pickle
+        arrays = {}
+        for column in data.columns:
+            values = np.asarray(data[column])
+            arrays[column] = (
+                values.astype(str) if values.dtype == object else values
+            )
+        np.savez_compressed(
+            output,
+            spc=np.asarray(spc.values, dtype=np.float32),
+            wl=np.asarray(spc.columns.values, dtype=np.float64),
+            **arrays
+        )
+        return
+
+    table = pd.concat(
+        [
+            data,
+            pd.DataFrame(
+                np.asarray(spc.values, dtype=np.float32),
+                columns=[str(wl) for wl in spc.columns.values],
+            ),
+        ],
+        axis=1,
+    )
+    if fmt == "parquet":
+        table.to_parquet(output, engine="pyarrow", index=False)
+    else:
+        table.to_feather(output)
+
+
+def _column_values(values: np.ndarray) -> List:
+    """Convert a column to plain python values (NaN/NaT become None)"""
+    if np.issubdtype(values.dtype, np.datetime64):
+        return [
+            None if pd.isna(value) else value
+            for value in pd.to_datetime(values).to_pydatetime()
+        ]
+    return [_python(value) for value in values]
+
+
+def _python(value):
+    """Plain python value of a cell, None for missing values"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return value
+
+
+def _sheet_name(name: str, used_names: set) -> str:
+    """Valid and unique Excel sheet name (max 31 chars, no []:*?/\\)"""
+    name = re.sub(r"[\[\]:*?/\\]", "_", name)[:31] or "Sheet"
+    candidate, i = name, 1
+    while candidate.lower() in used_names:
+        suffix = "_%s" % i
+        candidate = name[: 31 - len(suffix)] + suffix
+        i += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+
+class _XlsxWriter(object):
+    def __init__(self, output):
+        self.workbook = xlsxwriter.Workbook(
+            output,
+            {
+                "constant_memory": True,
+                "in_memory": False,
+                "nan_inf_to_errors": True,
+            },
+        )
+        self.datetime_format = self.workbook.add_format(
+            {"num_format": DATETIME_FORMAT}
+        )
+        self.sheet = None
+        self.row = 0
+
+    def add_sheet(self, name, widths):
+        self.sheet = self.workbook.add_worksheet(name)
+        self.row = 0
+        for i, width in enumerate(widths):
+            if width is not None:
+                self.sheet.set_column(i, i, width)
+
+    def write_row(self, values):
+        for col, value in enumerate(values):
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                self.sheet.write_datetime(
+                    self.row, col, value, self.datetime_format
+                )
+            else:
+                self.sheet.write(self.row, col, value)
+        self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class _OpenpyxlWriter(object):
+    def __init__(self, output):
+        import openpyxl
+
+        self.output = output
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = None
+
+    def add_sheet(self, name, widths):
+        from openpyxl.utils import get_column_letter
+
+        self.sheet = self.workbook.create_sheet(name)
+        for i, width in enumerate(widths):
+            if width is not None:
+                letter = get_column_letter(i + 1)
+                self.sheet.column_dimensions[letter].width = width
+
+    def write_row(self, values):
+        self.sheet.append(list(values))
+
+    def close(self):
+        self.workbook.save(self.output)
@@ -0,0 +1,112 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from models import db, UserFiles
+
+logger = logging.getLogger("IBCP-BOT")
+
+
+class UserFileRepository(object):
+    """Access to user files with a read-through cache of lookups
+
+    Every record read or inserted is kept (detached from the session) in
+    a thread-safe LRU of `cache_size` records shared by the webhook and
+    the job workers. Records handed out are never changed: the only
+    update, `set_content_hash`, drops the cached record instead, so the
+    next lookup reads the new one. Each call uses a single app context
+    and commit.
+    """
+
+    def __init__(self, app, cache_size: int = 1024):
+        self.app = app
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # type: OrderedDict[int, UserFiles]
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, **fields) -> UserFiles:
+        """Insert a user file and return it"""
+        userfile = UserFiles(**fields)
+        with self.app.app_context():
+            db.session.add(userfile)
+            db.session.commit()
+            # Load the attributes expired by the commit before detaching
+            db.session.refresh(userfile)
+            db.session.expunge(userfile)
+        logger.debug("Created a record for user file: %s" % userfile)
+        with self._lock:
+            self._put(userfile)
+        return userfile
+
+    def get(self, userfile_id: int) -> Optional[UserFiles]:
+        """User file by id, from the cache if possible"""
+        with self._lock:
+            userfile = self._cache.get(userfile_id)
+            if userfile is not None:
+                self._cache.move_to_end(userfile_id)
+                self.hits += 1
+                return userfile
+            self.misses += 1
+
+        with self.app.app_context():
+            userfile = db.session.query(UserFiles).get(userfile_id)
+            if userfile is None:
+                return None
+            db.session.expunge(userfile)
+        with self._lock:
+            self._put(userfile)
+        return userfile
+
+    def set_content_hash(self, userfile_id: int, sha256: str) -> None:
+        """Record the SHA-256 of the downloaded content of a user file"""
+        with self.app.app_context():
+            db.session.query(UserFiles).filter(
+                UserFiles.id == userfile_id
+            ).update(
+                {UserFiles.content_sha256: sha256}, synchronize_session=False
+            )
+            db.session.commit()
+        with self._lock:
+            self._cache.pop(userfile_id, None)
+
+    def content_hash(self, file_id: str) -> Optional[str]:
+        """SHA-256 of the content of a Telegram file downloaded before
+
+        The content behind a file_id never changes, so the hash recorded
+        for any user file with the file_id is valid.
+        """
+        with self.app.app_context():
+            return (
+                db.session.query(UserFiles.content_sha256)
+                .filter(
+                    UserFiles.file_id == file_id,
+                    UserFiles.content_sha256.isnot(None),
+                )
+                .limit(1)
+                .scalar()
+            )
+
+    def _put(self, userfile: UserFiles) -> None:
+        if self.cache_size <= 0:
+            return
+        self._cache[userfile.id] = userfile
+        self._cache.move_to_end(userfile.id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._cache),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,94 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from bwtek import parse_bwtek, parse_bwtek_cached
+from cache import DiskLRUCache
+
+HEADER = "File Version;BWSpec4.11_1\nc code;C123\nlaser_wavelength;785\n"
+COLUMNS = "Pixel;Raman Shift;Dark;Raw data #1;Dark, subtracted #1\n"
+DOT_DATA = "0;;1000.5;2000.25;999.75\n1;65.5;1001;2002.5;1001.5\n"
+
+
+def bwtek_file(decimal="."):
+    return (HEADER + COLUMNS + DOT_DATA.replace(".", decimal)).encode("utf-8")
+
+
+class BWTekTestCase(unittest.TestCase):
+    def check(self, parsed):
+        self.assertEqual(parsed.ccode, "C123")
+        self.assertEqual(parsed.metadata["laser_wavelength"], "785")
+        np.testing.assert_array_equal(parsed.data["Pixel"], [0, 1])
+        np.testing.assert_array_equal(
+            parsed.data["Raman Shift"], [np.nan, 65.5]
+        )
+        np.testing.assert_array_equal(parsed.data["Dark"], [1000.5, 1001])
+        np.testing.assert_array_equal(
+            parsed.data["Raw data #1"], [2000.25, 2002.5]
+        )
+
+
+class ParseBWTekTest(BWTekTestCase):
+    def test_dot_decimals(self):
+        self.check(parse_bwtek(bwtek_file(".")))
+
+    def test_comma_decimals(self):
+        self.check(parse_bwtek(bwtek_file(",")))
+
+    def test_column_selection(self):
+        columns = ("Raw data #1", "Dark, subtracted #1")
+        for decimal in (".", ","):
+            parsed = parse_bwtek(bwtek_file(decimal), columns)
+            self.assertEqual(sorted(parsed.data), sorted(columns))
+            np.testing.assert_array_equal(
+                parsed.data["Dark, subtracted #1"], [999.75, 1001.5]
+            )
+
+    def test_missing_column(self):
+        with self.assertRaises(TypeError):
+            parse_bwtek(bwtek_file(), ("Pixel", "Raw data #2"))
+
+    def test_not_bwtek_file(self):
+        with self.assertRaises(TypeError):
+            parse_bwtek(b"Pixel;Dark\n0;1.5\n")
+        with self.assertRaises(TypeError):
+            parse_bwtek((HEADER + "0;1.5\n").encode("utf-8"))
+
+
+class ParseBWTekCachedTest(BWTekTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = DiskLRUCache(self.dir, 1024 * 1024)
+
+    def test_cache_hit(self):
+        first = parse_bwtek_cached(bwtek_file(","), cache=self.cache)
+        second = parse_bwtek_cached(bwtek_file(","), cache=self.cache)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(second.metadata, first.metadata)
+        for column, values in first.data.items():
+            np.testing.assert_array_equal(second.data[column], values)
+
+    def test_columns_are_cached_apart(self):
+        parse_bwtek_cached(bwtek_file(), cache=self.cache)
+        parsed = parse_bwtek_cached(
+            bwtek_file(), ("Dark, subtracted #1",), cache=self.cache
+        )
+        self.assertEqual(self.cache.stats()["hits"], 0)
+        self.assertEqual(list(parsed.data), ["Dark, subtracted #1"])
+
+    def test_broken_entry(self):
+        parse_bwtek_cached(bwtek_file(), cache=self.cache)
+        for key in self.cache._keys():
+            with open(self.cache.path(key), "wb") as fp:
+                fp.write(b"broken")
+        self.check(parse_bwtek_cached(bwtek_file(), cache=self.cache))
+
+    def test_without_cache(self):
+        self.check(parse_bwtek_cached(bwtek_file()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+import os
+import json
+import types
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from flask import Flask
+
+import downloads
+from cache import DiskLRUCache
+from downloads import TelegramFileCache
+from models import db, UserFiles
+from repository import UserFileRepository
+
+try:
+    import utils
+except ImportError:
+    # patoolib is missing
+    utils = None
+
+TOKEN = "123:TEST"
+CONTENT = b"Raman Shift;Dark;Raw data #1\n" * 1000
+
+
+class FakeBotAPI(ThreadingMixIn, HTTPServer):
+    """Bot API server with getFile and file downloads, counting requests"""
+
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), _FakeBotAPIHandler)
+        self.files = files
+        self.calls = {"getFile": 0, "download": 0}
+        self.url = "http://127.0.0.1:%s" % self.server_port
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class _FakeBotAPIHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/bot%s/getFile" % TOKEN:
+            self.server.calls["getFile"] += 1
+            file_id = parse_qs(url.query)["file_id"][0]
+            content = self.server.files[file_id]
+            self._send(
+                json.dumps(
+                    {
+                        "ok": True,
+                        "result": {
+                            "file_id": file_id,
+                            "file_size": len(content),
+                            "file_path": "documents/%s" % file_id,
+                        },
+                    }
+                ).encode("utf-8")
+            )
+        elif url.path.startswith("/file/bot%s/documents/" % TOKEN):
+            self.server.calls["download"] += 1
+            self._send(self.server.files[url.path.rpartition("/")[2]])
+        else:
+            self.send_error(404)
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubBot(object):
+    """The part of telegram.Bot used to download files"""
+
+    def __init__(self, api_url):
+        self.base_url = "%s/bot%s" % (api_url, TOKEN)
+        self.base_file_url = "%s/file/bot%s" % (api_url, TOKEN)
+
+    def getFile(self, file_id):
+        response = requests.get(
+            self.base_url + "/getFile", params={"file_id": file_id}
+        )
+        response.raise_for_status()
+        return types.SimpleNamespace(bot=self, **response.json()["result"])
+
+
+class CountingBot(object):
+    def __init__(self):
+        self.calls = 0
+
+    def getFile(self, file_id):
+        self.calls += 1
+        return types.SimpleNamespace(file_id=file_id)
+
+
+class TelegramFileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch.object(
+            downloads.time, "monotonic", lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot = CountingBot()
+
+    def test_ttl_expiry(self):
+        files = TelegramFileCache(ttl=60)
+        first = files.get_file(self.bot, "A")
+        self.now += 59
+        self.assertIs(files.get_file(self.bot, "A"), first)
+        self.assertEqual(self.bot.calls, 1)
+        self.now += 2
+        self.assertIsNot(files.get_file(self.bot, "A"), first)
+        self.assertEqual(self.bot.calls, 2)
+        self.assertEqual(files.stats(), {"hits": 1, "misses": 2, "size": 1})
+
+    def test_max_entries(self):
+        files = TelegramFileCache(max_entries=2)
+        for file_id in ("A", "B", "A", "C", "A", "B"):
+            files.get_file(self.bot, file_id)
+        # B is the least recently used one when C is added
+        self.assertEqual(self.bot.calls, 4)
+
+
+@unittest.skipIf(utils is None, "utils needs patoolib")
+class DownloadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.api = FakeBotAPI({"FILE": CONTENT})
+        self.addCleanup(self.api.server_close)
+        self.addCleanup(self.api.shutdown)
+        self.bot = StubBot(self.api.url)
+
+        flask_app = Flask(__name__)
+        flask_app.config.update(
+            SQLALCHEMY_DATABASE_URI="sqlite:///%s"
+            % os.path.join(self.dir, "bot.db"),
+            SQLALCHEMY_TRACK_MODIFICATIONS=False,
+            DOWLOAD_DIR=os.path.join(self.dir, "downloads"),
+            TMP_DIR=os.path.join(self.dir, "tmp"),
+        )
+        db.init_app(flask_app)
+        with flask_app.app_context():
+            db.create_all()
+        os.makedirs(flask_app.config["DOWLOAD_DIR"])
+        self.app = types.ModuleType("app")
+        self.app.app = flask_app
+        self.app.userfiles = UserFileRepository(flask_app)
+        self.app.telegram_files = TelegramFileCache()
+        self.app.download_cache = DiskLRUCache(
+            os.path.join(self.dir, "downloads", "cache"), 10 * len(CONTENT)
+        )
+        patcher = mock.patch.dict("sys.modules", {"app": self.app})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, file_name="spectrum.txt"):
+        return self.app.userfiles.add(
+            user_id=1,
+            chat_id=1,
+            message_id=1,
+            file_id="FILE",
+            file_name=file_name,
+        ).id
+
+    def download(self, userfile_id, in_memory=False):
+        file_info = utils.get_file_info(self.bot, userfile_id)
+        sha256 = utils.download_file(
+            self.bot, 1, file_info, in_memory=in_memory
+        )
+        self.assertEqual(sha256, hashlib.sha256(CONTENT).hexdigest())
+        if in_memory:
+            self.assertEqual(file_info["content"], CONTENT)
+        else:
+            with open(file_info["download_path"], "rb") as fp:
+                self.assertEqual(fp.read(), CONTENT)
+        return file_info
+
+    def stored_hash(self, userfile_id):
+        with self.app.app.app_context():
+            return db.session.query(UserFiles).get(userfile_id).content_sha256
+
+    def test_first_download(self):
+        userfile_id = self.upload()
+        file_info = self.download(userfile_id)
+        self.assertEqual(self.api.calls, {"getFile": 1, "download": 1})
+        self.assertEqual(self.stored_hash(userfile_id), file_info["sha256"])
+        self.assertEqual(
+            self.app.userfiles.get(userfile_id).content_sha256,
+            file_info["sha256"],
+        )
+        # The cache entry is the download itself, not a copy
+        self.assertTrue(
+            os.path.samefile(
+                file_info["download_path"],
+                self.app.download_cache.path(file_info["sha256"]),
+            )
+        )
+
+    def test_repeated_action(self):
+        userfile_id = self.upload()
+        self.download(userfile_id)
+        file_info = self.download(userfile_id)
+        self.assertIsNone(file_info["file"])
+        self.assertEqual(self.api.calls, {"getFile": 1, "download": 1})
+
+    def test_other_upload_of_the_file(self):
+        self.download(self.upload())
+        self.app.userfiles.clear()
+        file_info = self.download(self.upload("copy.txt"))
+        self.assertIsNone(file_info["file"])
+        self.assertEqual(self.api.calls, {"getFile": 1, "download": 1})
+        self.assertEqual(self.app.download_cache.stats()["hits"], 1)
+
+    def test_evicted_content(self):
+        first = self.download(self.upload())
+        self.app.download_cache.remove(first["sha256"])
+        self.download(self.upload("copy.txt"))
+        self.assertEqual(self.api.calls, {"getFile": 1, "download": 2})
+
+    def test_evicted_after_lookup(self):
+        first = self.download(self.upload())
+        file_info = utils.get_file_info(self.bot, self.upload("copy.txt"))
+        self.assertIsNotNone(file_info["cached_path"])
+        self.app.download_cache.remove(first["sha256"])
+        utils.download_file(self.bot, 1, file_info)
+        # getFile is called only once the cached content is found missing
+        self.assertEqual(self.api.calls, {"getFile": 1, "download": 2})
+        with open(file_info["download_path"], "rb") as fp:
+            self.assertEqual(fp.read(), CONTENT)
+
+    def test_in_memory_download(self):
+        userfile_id = self.upload()
+        file_info = self.download(userfile_id, in_memory=True)
+        self.assertEqual(self.api.calls, {"getFile": 1, "download": 1})
+        self.assertEqual(self.stored_hash(userfile_id), file_info["sha256"])
+        self.assertEqual(os.listdir(self.app.app.config["DOWLOAD_DIR"]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
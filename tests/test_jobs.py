@@ -0,0 +1,212 @@
+import os
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import unittest
+
+from flask import Flask
+
+from jobs import JobQueue, NonRetryableJobError
+from models import db, Jobs
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.app = Flask(__name__)
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI="sqlite:///%s"
+            % os.path.join(self.dir, "bot.db"),
+            SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        )
+        db.init_app(self.app)
+        with self.app.app_context():
+            db.create_all()
+        self.runs = []
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def queue(self, handler=None, **kwargs):
+        options = {
+            "workers": 2,
+            "max_attempts": 3,
+            "retry_delay": 0,
+            "poll_interval": 0.02,
+        }
+        options.update(kwargs)
+        queue = JobQueue(
+            self.app,
+            handler or self.handler,
+            on_failure=lambda job, e: self.failures.append((job.id, e)),
+            **options
+        )
+        self.addCleanup(queue.stop)
+        return queue
+
+    def handler(self, job):
+        with self.lock:
+            self.runs.append(job.id)
+        return "%s.zip" % job.action
+
+    def job(self, job_id):
+        with self.app.app_context():
+            job = db.session.query(Jobs).get(job_id)
+            db.session.expunge(job)
+            return job
+
+    def wait_for(self, job_id, state, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.job(job_id)
+            if job.state == state:
+                return job
+            time.sleep(0.02)
+        self.fail("Job %s is %s, not %s" % (job_id, job.state, state))
+
+    def test_enqueue_dedup(self):
+        queue = self.queue()
+        job, created = queue.enqueue(1, "trans", 1, 1)
+        again, created_again = queue.enqueue(1, "trans", 1, 1)
+        other, created_other = queue.enqueue(1, "recal", 1, 1)
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(again.id, job.id)
+        self.assertTrue(created_other)
+        self.assertNotEqual(other.id, job.id)
+
+    def test_run(self):
+        queue = self.queue()
+        job, _ = queue.enqueue(1, "trans", 1, 1)
+        queue.start()
+        done = self.wait_for(job.id, "done")
+        self.assertEqual(done.result_path, "trans.zip")
+        self.assertEqual(done.attempts, 1)
+        self.assertEqual(self.runs, [job.id])
+        # Done jobs are not run again
+        _, created = queue.enqueue(1, "trans", 1, 1)
+        self.assertFalse(created)
+
+    def test_per_user_limit(self):
+        running = {}
+        peak = {}
+        release = threading.Event()
+
+        def handler(job):
+            with self.lock:
+                running[job.user_id] = running.get(job.user_id, 0) + 1
+                peak[job.user_id] = max(
+                    peak.get(job.user_id, 0), running[job.user_id]
+                )
+            release.wait(0.2)
+            with self.lock:
+                running[job.user_id] -= 1
+
+        queue = self.queue(handler, workers=4, per_user_limit=1)
+        jobs = [
+            queue.enqueue(userfile_id, "trans", user_id, 1)[0]
+            for userfile_id, user_id in ((1, 1), (2, 1), (3, 1), (4, 2))
+        ]
+        queue.start()
+        for job in jobs:
+            self.wait_for(job.id, "done")
+        self.assertEqual(peak, {1: 1, 2: 1})
+
+    def test_retry(self):
+        def handler(job):
+            self.handler(job)
+            if job.attempts < 2:
+                raise ValueError("temporary")
+
+        queue = self.queue(handler)
+        job, _ = queue.enqueue(1, "trans", 1, 1)
+        queue.start()
+        done = self.wait_for(job.id, "done")
+        self.assertEqual(done.attempts, 2)
+        self.assertEqual(self.failures, [])
+
+    def test_failure_after_all_attempts(self):
+        def handler(job):
+            self.handler(job)
+            raise ValueError("broken")
+
+        queue = self.queue(handler, max_attempts=2)
+        job, _ = queue.enqueue(1, "trans", 1, 1)
+        queue.start()
+        failed = self.wait_for(job.id, "failed")
+        self.assertEqual(failed.attempts, 2)
+        self.assertEqual(failed.error, "broken")
+        self.assertEqual(self.runs, [job.id, job.id])
+        self.assertEqual([job_id for job_id, _ in self.failures], [job.id])
+        # Failed jobs are requeued by the next enqueue
+        _, created = queue.enqueue(1, "trans", 1, 1)
+        self.assertTrue(created)
+
+    def test_non_retryable_failure(self):
+        def handler(job):
+            self.handler(job)
+            raise NonRetryableJobError("unsupported")
+
+        queue = self.queue(handler)
+        job, _ = queue.enqueue(1, "trans", 1, 1)
+        queue.start()
+        failed = self.wait_for(job.id, "failed")
+        self.assertEqual(failed.attempts, 1)
+        self.assertEqual(len(self.failures), 1)
+
+    def add_running(self, userfile_id, attempts, heartbeat_age):
+        beat = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=heartbeat_age
+        )
+        with self.app.app_context():
+            job = Jobs(
+                userfile_id=userfile_id,
+                user_id=userfile_id,
+                chat_id=1,
+                action="trans",
+                state="running",
+                attempts=attempts,
+                max_attempts=3,
+                started_at=beat,
+                heartbeat_at=beat,
+            )
+            db.session.add(job)
+            db.session.commit()
+            return job.id
+
+    def test_stale_jobs(self):
+        stale = self.add_running(1, attempts=1, heartbeat_age=60)
+        out_of_attempts = self.add_running(2, attempts=3, heartbeat_age=60)
+        alive = self.add_running(3, attempts=1, heartbeat_age=1)
+        queue = self.queue(stale_timeout=30)
+        queue.start()
+        self.assertEqual(self.wait_for(stale, "done").attempts, 2)
+        self.wait_for(out_of_attempts, "failed")
+        self.assertEqual(
+            [job_id for job_id, _ in self.failures], [out_of_attempts]
+        )
+        self.assertEqual(self.job(alive).state, "running")
+        self.assertEqual(self.runs, [stale])
+
+    def test_heartbeat_of_long_jobs(self):
+        def handler(job):
+            self.handler(job)
+            time.sleep(0.6)
+
+        queue = self.queue(
+            handler,
+            stale_timeout=0.3,
+            stale_check_interval=0.05,
+            heartbeat_interval=0.05,
+        )
+        job, _ = queue.enqueue(1, "trans", 1, 1)
+        queue.start()
+        self.wait_for(job.id, "done")
+        # The job is not taken for a stale one while it is running
+        self.assertEqual(self.runs, [job.id])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import zipper
+
+TEXT = b"Raman Shift;Dark;Raw data #1\n" * 1000
+# Already compressed data, it does not get smaller
+BINARY = os.urandom(4096)
+
+
+class WriteZipTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.files = {
+            "spectrum.txt": TEXT,
+            os.path.join("эксперимент 1", "спектр.txt"): TEXT,
+            "report.xlsx": BINARY,
+            "random.bin": BINARY,
+        }
+        for name, content in self.files.items():
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fp:
+                fp.write(content)
+
+    def write(self, members, **kwargs):
+        out = io.BytesIO()
+        zipper.write_zip(out, members, **kwargs)
+        out.seek(0)
+        return zipfile.ZipFile(out)
+
+    def file_members(self):
+        paths = [os.path.join(self.root, name) for name in self.files]
+        return zipper.file_members(self.root, paths)
+
+    def assertRoundtrip(self, zipf):
+        self.assertIsNone(zipf.testzip())
+        self.assertEqual(
+            {info.filename: zipf.read(info) for info in zipf.infolist()},
+            {
+                name.replace(os.sep, "/"): content
+                for name, content in self.files.items()
+            },
+        )
+
+    def compress_types(self, zipf):
+        return {info.filename: info.compress_type for info in zipf.infolist()}
+
+    def test_file_members(self):
+        with self.write(self.file_members(), workers=2) as zipf:
+            self.assertRoundtrip(zipf)
+            types = self.compress_types(zipf)
+            mode = zipf.getinfo("spectrum.txt").external_attr >> 16
+        self.assertEqual(types["spectrum.txt"], zipfile.ZIP_DEFLATED)
+        self.assertEqual(
+            types["эксперимент 1/спектр.txt"], zipfile.ZIP_DEFLATED
+        )
+        self.assertEqual(types["report.xlsx"], zipfile.ZIP_STORED)
+        self.assertEqual(types["random.bin"], zipfile.ZIP_STORED)
+        self.assertEqual(
+            mode, os.stat(os.path.join(self.root, "spectrum.txt")).st_mode
+        )
+
+    def test_content_members(self):
+        members = zipper.content_members(self.files.items())
+        with self.write(members) as zipf:
+            self.assertRoundtrip(zipf)
+
+    def test_level_0_stores(self):
+        with self.write(self.file_members(), level=0) as zipf:
+            self.assertRoundtrip(zipf)
+            types = set(self.compress_types(zipf).values())
+        self.assertEqual(types, {zipfile.ZIP_STORED})
+
+    def test_zip64_fallback(self):
+        # Archives over the limit are written by zipfile
+        with mock.patch.object(zipper, "ZIP_LIMIT", 1), mock.patch.object(
+            zipper, "_write_zip64", wraps=zipper._write_zip64
+        ) as write_zip64:
+            with self.write(self.file_members()) as zipf:
+                self.assertRoundtrip(zipf)
+                types = self.compress_types(zipf)
+        write_zip64.assert_called_once()
+        self.assertEqual(
+            types["эксперимент 1/спектр.txt"], zipfile.ZIP_DEFLATED
+        )
+        self.assertEqual(types["report.xlsx"], zipfile.ZIP_STORED)
+
+    def test_zip64_fallback_level(self):
+        with mock.patch.object(zipper, "ZIP_LIMIT", 1):
+            sizes = {}
+            for level in (0, 1, 9):
+                with self.write(self.file_members(), level=level) as zipf:
+                    self.assertRoundtrip(zipf)
+                    sizes[level] = zipf.getinfo("spectrum.txt").compress_size
+        self.assertEqual(sizes[0], len(TEXT))
+        self.assertLess(sizes[9], sizes[1])
+
+    def test_below_zip64_threshold(self):
+        with mock.patch.object(zipper, "_write_zip64") as write_zip64:
+            with self.write(self.file_members()) as zipf:
+                self.assertRoundtrip(zipf)
+        write_zip64.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import json
+import math
+import time
+import logging
+import threading
+import contextlib
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+# Structured (one JSON object per line) log of job traces
+trace_logger = logging.getLogger("IBCP-BOT.trace")
+
+PERCENTILES = (50, 90, 99)
+
+
+class StageStats(object):
+    """Thread-safe rolling durations of job stages
+
+    The last `window` durations of every stage are kept in memory to get
+    percentiles without any external storage.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._durations = {}  # type: Dict[str, deque]
+        self._counts = {}  # type: Dict[str, int]
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            if stage not in self._durations:
+                self._durations[stage] = deque(maxlen=self.window)
+                self._counts[stage] = 0
+            self._durations[stage].append(seconds)
+            self._counts[stage] += 1
+
+    def percentiles(
+        self, stage: str, percentiles: Sequence[float] = PERCENTILES
+    ) -> Dict[float, float]:
+        """Percentiles of the recent durations of a stage (nearest rank)"""
+        with self._lock:
+            durations = sorted(self._durations.get(stage, ()))
+        if not durations:
+            return {}
+        n = len(durations)
+        return {
+            p: durations[max(int(math.ceil(p / 100.0 * n)), 1) - 1]
+            for p in percentiles
+        }
+
+    def summary(self) -> Dict[str, Dict]:
+        """Count and percentiles of every stage"""
+        with self._lock:
+            stages = sorted(self._durations)
+            counts = dict(self._counts)
+        return {
+            stage: {
+                "count": counts[stage],
+                "percentiles": self.percentiles(stage),
+            }
+            for stage in stages
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._durations.clear()
+            self._counts.clear()
+
+
+# Process-wide stats of all jobs
+stage_stats = StageStats()
+
+
+class Trace(object):
+    """Durations, byte and file counts of the stages of a job
+
+    Stages are timed with `stage` blocks and `iterate` (for lazy stages
+    like extraction that run inside others). Time of a stage does not
+    include the time of the stages that ran inside it. `finish` writes the
+    trace to the structured log and adds the durations to `stats`.
+    """
+
+    def __init__(
+        self,
+        job_id: Optional[int],
+        action: str,
+        stats: Optional[StageStats] = None,
+    ):
+        self.job_id = job_id
+        self.action = action
+        self.stats = stage_stats if stats is None else stats
+        self.stages = []  # type: List[Dict]
+        self._started = time.perf_counter()
+        # Time of nested stages of every open stage
+        self._nested = []  # type: List[float]
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **counts) -> Iterator[Dict]:
+        """Time the block, the yielded dict is for counts (bytes, files)"""
+        info = dict(counts)
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self._add(name, elapsed - nested, info)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        """Yield items of `iterable` timing their production as a stage"""
+        total = 0.0
+        files = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed = time.perf_counter() - start
+                    total += elapsed
+                    if self._nested:
+                        self._nested[-1] += elapsed
+                files += 1
+                yield item
+        finally:
+            self._add(name, total, {"files": files})
+
+    def _add(self, name: str, seconds: float, counts: Dict) -> None:
+        stage = {"stage": name, "seconds": round(seconds, 6)}
+        stage.update((k, v) for k, v in counts.items() if v is not None)
+        self.stages.append(stage)
+
+    def finish(self, status: str) -> Dict:
+        """Log the trace and record its durations, returns the trace"""
+        total = time.perf_counter() - self._started
+        trace = {
+            "job": self.job_id,
+            "action": self.action,
+            "status": status,
+            "seconds": round(total, 6),
+            "stages": self.stages,
+        }
+        for stage in self.stages:
+            self.stats.add(stage["stage"], stage["seconds"])
+        self.stats.add("job", total)
+        trace_logger.info(json.dumps(trace))
+        return trace
@@ -1,34 +1,78 @@
+import io
 import os
+import uuid
 import shutil
 import logging
+import zlib
 import zipfile
 import patoolib
 
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+from cache import link_or_copy
+from downloads import (
+    file_url,
+    download_to_path,
+    download_to_buffer,
+    read_checksum,
+    write_checksum,
+)
+from zipper import content_members, file_members, write_zip
+
 
 def remove_extension(path):
     return os.path.splitext(path)[0]
 
 
 def get_file_info(bot, userfile_id):
-    from app import app, db
-    from models import UserFiles
-
-    with app.app_context():
-        userfile = db.session.query(UserFiles).get(userfile_id)
-        file_message_id = userfile.message_id
-        file_id = userfile.file_id
-        file = bot.getFile(file_id)
-        filename = userfile.file_name
+    """Paths and Telegram file of a user file
+
+    Contents downloaded before need no getFile call: `sha256` is set and
+    `file` is None then. The content is either the complete download of
+    the user file, left by an earlier action, or the `cached_path` of the
+    same Telegram file in the download cache. `file` is only requested by
+    `download_file` if that has been removed meanwhile.
+    """
+    from app import app, userfiles, telegram_files, download_cache
+
+    userfile = userfiles.get(userfile_id)
+    file_message_id = userfile.message_id
+    file_id = userfile.file_id
+    filename = userfile.file_name
+    download_path = os.path.join(
+        app.config["DOWLOAD_DIR"], "%s %s" % (userfile_id, filename)
+    )
+    file = None
+    cached_path = None
+    sha256 = read_checksum(download_path)
+    if sha256 is not None:
+        file_size = os.path.getsize(download_path)
+    else:
+        # The content behind a file_id never changes
+        sha256 = userfile.content_sha256 or userfiles.content_hash(file_id)
+        cached_path = download_cache.get(sha256) if sha256 else None
+        try:
+            file_size = os.path.getsize(cached_path) if cached_path else None
+        except OSError:
+            cached_path = None
+        if cached_path is None:
+            sha256 = None
+            file = telegram_files.get_file(bot, file_id)
+            file_size = file.file_size
     return {
         "file_id": file_id,
         "userfile_id": userfile_id,
         "file": file,
+        "file_size": file_size,
+        "sha256": sha256,
+        "cached_path": cached_path,
         "message_id": file_message_id,
         "filename": filename,
         "file_extension": filename.split(".")[-1],
-        "download_path": os.path.join(
-            app.config["DOWLOAD_DIR"], "%s %s" % (userfile_id, filename)
-        ),
+        "download_path": download_path,
         "extract_path": remove_extension(
             os.path.join(
                 app.config["TMP_DIR"], "%s %s" % (userfile_id, filename)
@@ -37,7 +81,18 @@ def get_file_info(bot, userfile_id):
     }
 
 
-def extract_file(bot, chat_id, file_info):
+def download_file(bot, chat_id, file_info, in_memory=False):
+    """Download the user file once and return SHA-256 of its content
+
+    The file is downloaded in chunks and resumed after failures, see
+    `downloads.download_to_path`. With `in_memory` the content is kept in
+    `file_info["content"]` and nothing is written to disk. Downloads to
+    disk are linked to the download cache by their SHA-256, which is
+    recorded with the user file, so other uploads of the same Telegram
+    file are not downloaded again.
+    """
+    from app import download_cache, telegram_files, userfiles
+
     if file_info["file_extension"] not in ("zip", "rar", "txt"):
         logging.error("Incorrect file extension.")
         bot.send_message(
@@ -49,43 +104,229 @@ def extract_file(bot, chat_id, file_info):
             "Unsupported file format: %s." % file_info["file_extension"]
         )
 
-    file_info["file"].download(custom_path=file_info["download_path"])
+    # Set by get_file_info for contents downloaded before
+    if file_info["sha256"] is not None:
+        try:
+            _reuse_download(file_info, in_memory)
+            logging.debug("Reusing downloaded %s" % file_info["file_id"])
+            return file_info["sha256"]
+        except OSError:
+            # Evicted from the download cache since
+            pass
+    if file_info["file"] is None:
+        file_info["file"] = telegram_files.get_file(bot, file_info["file_id"])
+        file_info["file_size"] = file_info["file"].file_size
+
+    url = file_url(file_info["file"])
+    file_size = file_info["file_size"]
+    if in_memory:
+        buffer = io.BytesIO()
+        file_info["sha256"] = download_to_buffer(url, buffer, file_size)
+        file_info["content"] = buffer.getvalue()
+    else:
+        file_info["sha256"] = download_to_path(
+            url, file_info["download_path"], file_size
+        )
+        download_cache.put_link(
+            file_info["sha256"], file_info["download_path"]
+        )
+    userfiles.set_content_hash(file_info["userfile_id"], file_info["sha256"])
+    return file_info["sha256"]
+
+
+def _reuse_download(file_info, in_memory):
+    """Take the content found by get_file_info, raises OSError if it is gone"""
+    path = file_info["cached_path"] or file_info["download_path"]
+    if in_memory:
+        with open(path, "rb") as fp:
+            file_info["content"] = fp.read()
+    elif path != file_info["download_path"]:
+        # The download must be complete once it has a checksum
+        tmp = "%s.%s.tmp" % (file_info["download_path"], uuid.uuid4().hex)
+        link_or_copy(path, tmp)
+        os.replace(tmp, file_info["download_path"])
+        write_checksum(file_info["download_path"], file_info["sha256"])
+
+
+class ArchiveError(ValueError):
+    """The user archive could not be unpacked"""
+
+
+class MemoryDir(dict):
+    """In-memory replacement of an extract directory
+
+    Maps paths of files under the virtual directory `path` to their
+    content, so the same path logic works for both disk and memory.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def listdir(self, path):
+        names = set()
+        for filepath in self:
+            relpath = os.path.relpath(filepath, path)
+            if not relpath.startswith(".."):
+                names.add(relpath.split(os.path.sep)[0])
+        return sorted(names)
+
+    def isdir(self, path):
+        prefix = os.path.join(path, "")
+        return any(filepath.startswith(prefix) for filepath in self)
+
+    def rmtree(self, path):
+        prefix = os.path.join(path, "")
+        for filepath in [f for f in self if f.startswith(prefix)]:
+            del self[filepath]
+
+    def open(self, filepath):
+        return io.BytesIO(self[filepath])
+
+
+def extract_file(bot, chat_id, file_info, accept=None):
+    """Extract the downloaded user file to its extract path
 
+    This is a generator: archive members are extracted one by one and the
+    path of every extracted file is yielded as soon as it is written, so
+    the caller can process files while the rest is being unpacked. Only
+    members whose path is accepted by `accept` (all by default) are
+    extracted.
+    """
     if os.path.exists(file_info["extract_path"]):
         shutil.rmtree(file_info["extract_path"], ignore_errors=True)
     os.makedirs(file_info["extract_path"])
 
     if file_info["file_extension"] == "txt":
-        file_info["file"].download(
-            custom_path=os.path.join(
-                file_info["extract_path"], file_info["filename"]
-            )
+        # The file has been downloaded already, copy it instead of
+        # downloading once again. It is not hard linked, because actions
+        # rewrite files in place and that would change the download too.
+        filepath = os.path.join(
+            file_info["extract_path"], file_info["filename"]
         )
+        shutil.copyfile(file_info["download_path"], filepath)
+        yield filepath
     elif file_info["file_extension"] in ("zip", "rar"):
         try:
-            patoolib.extract_archive(
-                file_info["download_path"], outdir=file_info["extract_path"]
-            )
+            for filepath in iter_archive(
+                file_info["download_path"], file_info["extract_path"], accept
+            ):
+                yield filepath
         except Exception as e:
-            logging.error(e)
-            bot.send_message(
-                chat_id=chat_id,
-                text=[
-                    "Упс! Не удалось распаковать архив \U0001F631",
-                    "Проверьте, что файл в правильном формате, если так,"
-                    + " то передайте следующую информацию администратору, чтобы он все исправил:",
-                    "Error on unpacking file. User file: %s"
-                    % (file_info["userfile_id"],),
-                ].join("\n"),
-            )
-            raise
-    return "OK"
+            _notify_unpack_error(bot, chat_id, file_info, e)
+            raise ArchiveError(e)
+
+
+def extract_to_memory(bot, chat_id, file_info, accept=None):
+    """Extract the user file downloaded to memory into a MemoryDir
+
+    Only *.txt and *.zip files are supported.
+    """
+    tree = MemoryDir(file_info["extract_path"])
+    if file_info["file_extension"] == "txt":
+        filepath = os.path.join(tree.path, file_info["filename"])
+        tree[filepath] = file_info["content"]
+    elif file_info["file_extension"] == "zip":
+        try:
+            with zipfile.ZipFile(io.BytesIO(file_info["content"])) as archive:
+                for member, name in _iter_members(archive, accept):
+                    tree[os.path.join(tree.path, name)] = archive.read(member)
+        except Exception as e:
+            _notify_unpack_error(bot, chat_id, file_info, e)
+            raise ArchiveError(e)
+    else:
+        raise ValueError(
+            "Unsupported file format for in-memory processing: %s."
+            % file_info["file_extension"]
+        )
+    return tree
+
+
+def _notify_unpack_error(bot, chat_id, file_info, error):
+    logging.error(error)
+    bot.send_message(
+        chat_id=chat_id,
+        text="\n".join(
+            [
+                "Упс! Не удалось распаковать архив \U0001F631",
+                "Проверьте, что файл в правильном формате, если так,"
+                + " то передайте следующую информацию администратору, чтобы он все исправил:",
+                "Error on unpacking file. User file: %s"
+                % (file_info["userfile_id"],),
+            ]
+        ),
+    )
+
+
+def iter_archive(archive_path, outdir, accept=None):
+    """Extract accepted members of a zip or rar archive one by one
+
+    Yields paths of extracted files. Zip archives are read natively, rar
+    archives with `rarfile` if it is installed, otherwise the archive is
+    fully extracted by patool first.
+    """
+    if zipfile.is_zipfile(archive_path):
+        archive = zipfile.ZipFile(archive_path)
+    elif rarfile is not None and rarfile.is_rarfile(archive_path):
+        archive = rarfile.RarFile(archive_path)
+    else:
+        patoolib.extract_archive(archive_path, outdir=outdir)
+        for root, dirs, files in os.walk(outdir):
+            dirs.sort()
+            for file in sorted(files):
+                filepath = os.path.join(root, file)
+                if accept is None or accept(os.path.relpath(filepath, outdir)):
+                    yield filepath
+        return
+
+    with archive:
+        for member, name in _iter_members(archive, accept):
+            filepath = os.path.join(outdir, name)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with archive.open(member) as src, open(filepath, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            yield filepath
+
+
+def _iter_members(archive, accept=None):
+    """Accepted file members of a zip/rar archive with safe relative names"""
+    for member in archive.infolist():
+        if member.is_dir():
+            continue
+        name = _safe_member_name(member.filename)
+        if name is None or (accept is not None and not accept(name)):
+            continue
+        yield member, name
+
+
+def _safe_member_name(name):
+    """Normalized relative member path or None if it points outside"""
+    name = os.path.normpath(name.replace("\\", "/")).lstrip("/")
+    if name in (".", "..") or name.startswith("../") or os.path.isabs(name):
+        return None
+    return name
+
+
+def zip_memory_dir(tree, level=zlib.Z_DEFAULT_COMPRESSION, workers=None):
+    """Zip content of a MemoryDir to bytes"""
+    buffer = io.BytesIO()
+    write_zip(
+        buffer,
+        content_members(
+            (os.path.relpath(filepath, tree.path), tree[filepath])
+            for filepath in sorted(tree)
+        ),
+        level,
+        workers,
+    )
+    return buffer.getvalue()
 
 
-def zipdir(path, out):
-    zipf = zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED)
+def zipdir(path, out, level=zlib.Z_DEFAULT_COMPRESSION, workers=None):
+    """Zip files of a directory, see zipper.write_zip for the options"""
+    paths = []
     for root, dirs, files in os.walk(path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            zipf.write(file_path, os.path.relpath(file_path, path))
-    zipf.close()
+        dirs.sort()
+        paths.extend(os.path.join(root, file) for file in sorted(files))
+    with open(out, "wb") as fp:
+        write_zip(fp, file_members(path, paths), level, workers)
@@ -0,0 +1,228 @@
+import io
+import os
+import sys
+import time
+import zlib
+import struct
+import shutil
+import zipfile
+import collections
+import concurrent.futures
+from typing import BinaryIO, Callable, Iterable, NamedTuple, Optional, Tuple
+
+# Members which are compressed already are stored as is
+STORED_EXTENSIONS = (
+    ".zip",
+    ".rar",
+    ".gz",
+    ".npz",
+    ".parquet",
+    ".feather",
+    ".xlsx",
+    ".png",
+    ".jpg",
+    ".jpeg",
+)
+# Larger archives need ZIP64 records, they are written by zipfile
+ZIP_LIMIT = 0xFFFFFFFF
+ZIP_MAX_MEMBERS = 0xFFFF
+# Upper bound of the header bytes of a member (names are < 64 KB)
+ZIP_MEMBER_OVERHEAD = 0x20000
+
+Member = NamedTuple(
+    "Member",
+    [
+        ("arcname", str),
+        ("open", Callable[[], BinaryIO]),
+        ("size", int),
+        ("date_time", Tuple[int, int, int, int, int, int]),
+        ("mode", int),
+    ],
+)
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_END_RECORD = struct.Struct("<4s4H2LH")
+_UTF8_FLAG = 0x800
+
+
+def file_members(root: str, paths: Iterable[str]) -> Iterable[Member]:
+    """Members of files under `root`, named by their path relative to it"""
+    for path in paths:
+        st = os.stat(path)
+        yield Member(
+            os.path.relpath(path, root),
+            _file_opener(path),
+            st.st_size,
+            time.localtime(st.st_mtime)[:6],
+            st.st_mode & 0xFFFF,
+        )
+
+
+def content_members(items: Iterable[Tuple[str, bytes]]) -> Iterable[Member]:
+    """Members of in-memory contents, stamped with the current time"""
+    now = time.localtime()[:6]
+    for arcname, content in items:
+        yield Member(
+            arcname,
+            lambda c=content: io.BytesIO(c),
+            len(content),
+            now,
+            0o100644,
+        )
+
+
+def write_zip(
+    out: BinaryIO,
+    members: Iterable[Member],
+    level: int = zlib.Z_DEFAULT_COMPRESSION,
+    workers: Optional[int] = None,
+) -> None:
+    """Write a zip archive of `members` to a writable binary stream
+
+    Members are read and deflated by a pool of `workers` threads (zlib
+    releases the GIL) while the archive is written sequentially in order,
+    so `out` does not have to be seekable and only a few members are kept
+    in memory at once. Level 0 and STORED_EXTENSIONS members are stored,
+    as well as members that deflate does not make smaller.
+    """
+    members = list(members)
+    if (
+        len(members) > ZIP_MAX_MEMBERS
+        or sum(member.size + ZIP_MEMBER_OVERHEAD for member in members)
+        >= ZIP_LIMIT
+    ):
+        _write_zip64(out, members, level)
+        return
+
+    workers = workers or min(4, os.cpu_count() or 1)
+    central = []
+    offset = 0
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for member in members:
+            pending.append(executor.submit(_compress, member, level))
+            # Bound memory: wait for the oldest member when the pool is busy
+            if len(pending) > 2 * workers:
+                offset = _write_member(out, pending.popleft(), central, offset)
+        while pending:
+            offset = _write_member(out, pending.popleft(), central, offset)
+
+    size = 0
+    for record in central:
+        out.write(record)
+        size += len(record)
+    out.write(
+        _END_RECORD.pack(
+            b"PK\005\006", 0, 0, len(central), len(central), size, offset, 0
+        )
+    )
+
+
+def _file_opener(path: str) -> Callable[[], BinaryIO]:
+    return lambda: open(path, "rb")
+
+
+def _compress(
+    member: Member, level: int
+) -> Tuple[Member, int, int, int, bytes]:
+    """Member, compression method, CRC-32, size and data to write"""
+    with member.open() as fp:
+        content = fp.read()
+    crc = zlib.crc32(content) & 0xFFFFFFFF
+    if level != 0 and not member.arcname.lower().endswith(STORED_EXTENSIONS):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(content) + compressor.flush()
+        if len(data) < len(content):
+            return member, zipfile.ZIP_DEFLATED, crc, len(content), data
+    return member, zipfile.ZIP_STORED, crc, len(content), content
+
+
+def _write_member(out: BinaryIO, future, central: list, offset: int) -> int:
+    """Write the local header and data, returns the offset of the next one"""
+    member, method, crc, size, data = future.result()
+    name = member.arcname.replace(os.sep, "/")
+    try:
+        filename = name.encode("ascii")
+        flags = 0
+    except UnicodeEncodeError:
+        filename = name.encode("utf-8")
+        flags = _UTF8_FLAG
+    dostime, dosdate = _dos_date_time(member.date_time)
+    header = _LOCAL_HEADER.pack(
+        b"PK\003\004",
+        20,
+        0,
+        flags,
+        method,
+        dostime,
+        dosdate,
+        crc,
+        len(data),
+        size,
+        len(filename),
+        0,
+    )
+    out.write(header)
+    out.write(filename)
+    out.write(data)
+    central.append(
+        _CENTRAL_HEADER.pack(
+            b"PK\001\002",
+            20,
+            3,  # unix, for the file mode in the external attributes
+            20,
+            0,
+            flags,
+            method,
+            dostime,
+            dosdate,
+            crc,
+            len(data),
+            size,
+            len(filename),
+            0,
+            0,
+            0,
+            0,
+            member.mode << 16,
+            offset,
+        )
+        + filename
+    )
+    return offset + len(header) + len(filename) + len(data)
+
+
+def _dos_date_time(date_time: Tuple[int, ...]) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (
+        hour << 11 | minute << 5 | second // 2,
+        (year - 1980) << 9 | month << 5 | day,
+    )
+
+
+def _write_zip64(out: BinaryIO, members: Iterable[Member], level: int) -> None:
+    """Serial fallback for archives too large for plain zip records
+
+    Members are streamed, so they do not have to fit in memory.
+    """
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for member in members:
+            info = zipfile.ZipInfo(member.arcname, member.date_time)
+            info.external_attr = member.mode << 16
+            # Sizes are known, ZIP64 records are used for large members
+            info.file_size = member.size
+            stored = level == 0 or member.arcname.lower().endswith(
+                STORED_EXTENSIONS
+            )
+            info.compress_type = (
+                zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            )
+            # Levels are supported since Python 3.7 (public as
+            # `compress_level` since 3.13, which keeps the old name)
+            if not stored and sys.version_info >= (3, 7):
+                info._compresslevel = level
+            with member.open() as src, zipf.open(info, "w") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)